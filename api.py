@@ -2,16 +2,31 @@
 # -*- coding: utf-8 -*-
 
 import abc
-import json
+import errno
+import re
+import time
 import datetime
 from dateutil.relativedelta import relativedelta
 import logging
 import hashlib
+import hmac
 import uuid
+import itertools
+import os
+import signal
+import threading
+import Queue
 from optparse import OptionParser
 from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
-from scoring import get_score, get_interests
-from store import Store
+from scoring import get_score, get_score_key, get_scores_many, get_interests_many, add_scoring_options, \
+    scoring_from_options
+import logs
+import metrics
+import profiling
+import serializers
+from logs import add_logging_options, logging_from_options
+from profiling import add_profiling_options, profiling_from_options
+from store import Store, add_store_options, store_from_options
 
 
 SALT = "Otus"
@@ -40,33 +55,52 @@ GENDERS = {
 }
 INSUFFICIENT_ARG_PAIRS_MESSAGE = "least required pairs: (phone, email), (first_name, last_name), (gender, birthday)"
 INVALID_ARGS_MESSAGE = "Invalid arguments: "
-ALLOWED_METHODS = ["online_score", "client_interests"]
+ALLOWED_METHODS = ["online_score", "client_interests", "online_score_batch"]
+MAX_BATCH_SIZE = 1000
+DATE_PATTERN = re.compile(r"(\d{1,2})\.(\d{1,2})\.(\d{4})\Z")
+MAX_AGE = 70
+# verified (account, login) pairs whose token digest is kept
+AUTH_CACHE_SIZE = 10000
+# accepted connections waiting for a free worker thread, per thread
+PENDING_CONNECTIONS_PER_THREAD = 4
+# seconds a kept-alive connection may stay idle, and requests served on it
+KEEPALIVE_TIMEOUT = 15
+MAX_REQUESTS_PER_CONNECTION = 100
 
 
 
 class BaseField(object):
+    """Validating descriptor, the value lives in a slot of the request instance.
 
-    value = None
+    `name` and `slot` are filled in by RequestMeta when the request class is created.
+    """
+
+    # keeps the declaration order of the fields
+    creation_counter = itertools.count()
 
     def __init__(self, required=False, nullable=True):
         self.required = required
         self.nullable = nullable
+        self.name = None
+        self.slot = None
+        self.order = next(self.creation_counter)
 
     def __get__(self, instance, owner):
-        return self.value
+        if instance is None:
+            return self
+        return getattr(instance, self.slot, None)
 
     def __set__(self, instance, value):
-        self.value = None
+        setattr(instance, self.slot, None)
         self._validate_required(value)
         if value is None:
             return
         self._validate_nullable(value)
-        self._validate(value)
-        if not self.value:
-            self.value = value
+        setattr(instance, self.slot, self._validate(value))
 
     def _validate(self, value):
-        pass
+        # returns the value to be stored
+        return value
 
     def _validate_required(self, value):
         if self.required and value is None:
@@ -85,32 +119,34 @@ class CharField(BaseField):
         if not isinstance(value, (str, unicode)):
             log_errors("{self.__class__.__name__} is incorrect".format(self=self))
             raise TypeError
+        return value
 
 
 class EmailField(CharField):
     def _validate(self, value):
-        super(EmailField, self)._validate(value)
-        value = str(value).strip()
-        if not value:
-            return
-        lacks_at_symbol = len(value.split("@")) != 2
+        value = super(EmailField, self)._validate(value)
+        stripped = str(value).strip()
+        if not stripped:
+            return value
+        lacks_at_symbol = len(stripped.split("@")) != 2
         if lacks_at_symbol:
             log_errors("Incorrect email, ValueError, missing @")
             raise ValueError
+        return value
 
 
 class PhoneField(CharField):
     def _validate(self, value):
-        super(PhoneField, self)._validate(value)
-        value = str(value).strip()
-        if not value:
-            return
-        length_is_11 = len(value) == 11
-        starts_with_7 = value.startswith("7")
+        value = super(PhoneField, self)._validate(value)
+        stripped = str(value).strip()
+        if not stripped:
+            return value
+        length_is_11 = len(stripped) == 11
+        starts_with_7 = stripped.startswith("7")
         if not (length_is_11 and starts_with_7):
             log_errors("Incorrect phone")
             raise ValueError
-        return
+        return value
 
 
 
@@ -119,17 +155,54 @@ class ArgumentsField(BaseField):
         if not isinstance(value, dict):
             log_errors("Incorrect arguments, should be dict".format(self=self))
             raise TypeError
+        return value
+
+
+
+class ArgumentsListField(BaseField):
+    def _validate(self, value):
+        if not isinstance(value, list) or not all(isinstance(item, dict) for item in value):
+            log_errors("Incorrect arguments list, should be a list of dicts")
+            raise TypeError
+        if not value or len(value) > MAX_BATCH_SIZE:
+            log_errors("Arguments list should have 1 to %s items" % MAX_BATCH_SIZE)
+            raise ValueError
+        return value
+
+
+
+def parse_date(value):
+    """Parses dd.mm.yyyy like strptime(value, '%d.%m.%Y'), without strptime's locale machinery."""
+    match = DATE_PATTERN.match(value)
+    if match is None:
+        raise ValueError("%r does not match dd.mm.yyyy" % value)
+    day, month, year = match.groups()
+    return datetime.datetime(int(year), int(month), int(day))
+
+
+# (day, the earliest birthday accepted on that day)
+_birthday_cutoff = (None, None)
+
+
+def get_birthday_cutoff():
+    global _birthday_cutoff
+    today = datetime.date.today()
+    day, cutoff = _birthday_cutoff
+    if day != today:
+        cutoff = datetime.datetime(today.year, today.month, today.day) - relativedelta(years=MAX_AGE)
+        _birthday_cutoff = (today, cutoff)
+    return cutoff
 
 
 
 class DateField(CharField):
     def _validate(self, value):
-        super(DateField, self)._validate(value)
-        value = str(value).strip()
-        if not value:
-            return
+        value = super(DateField, self)._validate(value)
+        stripped = str(value).strip()
+        if not stripped:
+            return value
         try:
-            self.value = datetime.datetime.strptime(value, '%d.%m.%Y')
+            return parse_date(stripped)
         except ValueError:
             log_errors("Incorrect data format, should be dd.mm.yyyy")
             raise ValueError
@@ -138,14 +211,15 @@ class DateField(CharField):
 
 class BirthDayField(DateField):
     def _validate(self, value):
-        super(BirthDayField, self)._validate(value)
-        value = str(value).strip()
-        if not value:
-            return
-        seventy_years_ago = datetime.datetime.now() - relativedelta(years=70)
-        if datetime.datetime.strptime(value, '%d.%m.%Y') < seventy_years_ago:
+        birthday = super(BirthDayField, self)._validate(value)
+        if not isinstance(birthday, datetime.datetime):
+            return birthday
+        # birthdays are midnights, so the birthday exactly MAX_AGE years ago
+        # is already older than the cutoff at any time of the day
+        if birthday <= get_birthday_cutoff():
             log_errors("The system supports only 70 year ages only")
             raise ValueError
+        return birthday
 
 
 
@@ -157,6 +231,7 @@ class GenderField(BaseField):
         if value not in [0, 1, 2, None]:
             log_errors("ValueError, gender input. should be 0, 1, 2")
             raise TypeError
+        return value
 
 
 
@@ -164,28 +239,64 @@ class ClientIDsField(BaseField):
     def _validate(self, value):
         if isinstance(value, list):
             if len(filter(int, value)) == len(value):
-                return
+                return value
         log_errors("Wrong client id input")
         raise TypeError
 
 
 
-class BaseRequest(object):
-    def __init__(self, data):
-        self.invalid_fields = []
-        self.has_fields = []
-        class_attribute_fields = [(key, field) for key, field in self.__class__.__dict__.iteritems()
-                                    if not key.startswith("__")
-                                    and isinstance(field, BaseField)]
-        for attribute, field in class_attribute_fields:
+def compile_validator(fields):
+    """Build the function that populates a request from its arguments dict."""
+    setters = tuple((field.name, field.__set__) for field in fields)
+
+    def validate(request, data):
+        invalid_fields, has_fields = [], []
+        get = data.get
+        for attribute, set_value in setters:
             try:
-                setattr(self, attribute, data.get(attribute))
-                self.has_fields.append(attribute)
-            except (TypeError, ValueError), e:
+                set_value(request, get(attribute))
+                has_fields.append(attribute)
+            except (TypeError, ValueError):
                 # to send the errors to the api users
-                self.invalid_fields.append(attribute)
+                invalid_fields.append(attribute)
+        return invalid_fields, has_fields
+    return validate
+
+
+
+class RequestMeta(type):
+    """Compiles the schema of a request class once, at class creation.
+
+    Names the declared fields, generates a slot per field so values are
+    stored on the request instance instead of the shared descriptor, and
+    builds the ordered field table and validator used by BaseRequest.
+    """
+
+    def __new__(mcs, name, bases, attrs):
+        slots = list(attrs.get("__slots__", ()))
+        declared = []
+        for attribute, field in attrs.items():
+            if isinstance(field, BaseField):
+                field.name = attribute
+                field.slot = "_" + attribute
+                slots.append(field.slot)
+                declared.append(field)
+        attrs["__slots__"] = tuple(slots)
+        inherited = [field for base in bases for field in getattr(base, "_fields", ())]
+        fields = tuple(inherited + sorted(declared, key=lambda f: f.order))
+        attrs["_fields"] = fields
+        attrs["_validate_data"] = staticmethod(compile_validator(fields))
+        return super(RequestMeta, mcs).__new__(mcs, name, bases, attrs)
+
 
 
+class BaseRequest(object):
+    __metaclass__ = RequestMeta
+    __slots__ = ("invalid_fields", "has_fields")
+
+    def __init__(self, data):
+        self.invalid_fields, self.has_fields = self._validate_data(self, data)
+
     def is_valid(self):
         return len(self.invalid_fields)
 
@@ -209,6 +320,7 @@ class ClientsInterestsRequest(BaseRequest):
 
 
 class OnlineScoreRequest(BaseRequest):
+    __slots__ = ("_score_key",)
     first_name = CharField(required=False, nullable=True)
     last_name = CharField(required=False, nullable=True)
     email = EmailField(required=False, nullable=True)
@@ -248,6 +360,25 @@ class OnlineScoreRequest(BaseRequest):
             return False
         return True
 
+    @property
+    def score_arguments(self):
+        return {"phone": self.phone, "email": self.email,
+                "birthday": self.birthday, "gender": self.gender,
+                "first_name": self.first_name, "last_name": self.last_name}
+
+    @property
+    def score_key(self):
+        """The score cache key, derived from the parsed fields on first use."""
+        key = getattr(self, "_score_key", None)
+        if key is None:
+            key = self._score_key = get_score_key(self.first_name, self.last_name, self.birthday)
+        return key
+
+
+
+class OnlineScoreBatchRequest(BaseRequest):
+    items = ArgumentsListField(required=True, nullable=False)
+
 
 
 class MethodRequest(BaseRequest):
@@ -276,29 +407,24 @@ class Response(object):
 
     def set_response(self, method_request):
         if method_request.is_valid():
-            self.response, self.code = "{}{}".format(INVALID_ARGS_MESSAGE, ", ".join(method_request.invalid_fields)), api.INVALID_REQUEST
+            self.response, self.code = "{}{}".format(INVALID_ARGS_MESSAGE, ", ".join(method_request.invalid_fields)), INVALID_REQUEST
         elif method_request.method not in ALLOWED_METHODS:
             self.response, self.code = ERRORS[INVALID_REQUEST], INVALID_REQUEST
         else:
-            self.process(method_request)
+            with metrics.timed("process"):
+                self.process(method_request)
 
     def get_score_from_request(self, request, is_admin):
-
-        phone = request.phone
-        email = request.email
-        birthday = request.birthday
-        gender = request.gender
-        first_name = request.first_name
-        last_name = request.last_name
-
         if is_admin:
             return 42
-        return get_score(self.store, phone, email,
-                         birthday=birthday, gender=gender,
-                         first_name=first_name, last_name=last_name)
+        return get_score(self.store, key=request.score_key, **request.score_arguments)
+
+    def get_scores_from_batch(self, batch_request, is_admin):
+        return score_items(self.store, batch_request.items, is_admin)
 
     def get_interests_from_request(self, method_request):
-        return {i: get_interests(self.store, i) for i in method_request.client_ids}
+        client_ids = method_request.client_ids
+        return dict(zip(client_ids, get_interests_many(self.store, client_ids)))
 
     def process(self, method_request):
         if method_request.method == "online_score":
@@ -317,72 +443,334 @@ class Response(object):
             else:
                 self.response, self.code = self.get_interests_from_request(request), OK
                 self.context['nclients'] = len(request.client_ids)
+        elif method_request.method == "online_score_batch":
+            request = OnlineScoreBatchRequest(method_request.arguments)
+            if request.invalid_fields:
+                self.response, self.code = "{}{}".format(INVALID_ARGS_MESSAGE, ", ".join(request.invalid_fields)), INVALID_REQUEST
+            else:
+                self.response, self.code = {"scores": self.get_scores_from_batch(request, method_request.is_admin)}, OK
+                self.context['nitems'] = len(request.items)
+
+
+def score_items(store, items, is_admin=False):
+    """Scores a list of online_score arguments, reports the invalid ones per item."""
+    results, valid = [], []
+    for arguments in items:
+        request = OnlineScoreRequest(arguments)
+        if request.invalid_fields:
+            result = {"error": "{}{}".format(INVALID_ARGS_MESSAGE, ", ".join(request.invalid_fields)),
+                      "code": INVALID_REQUEST}
+        elif not request.is_valid():
+            result = {"error": INSUFFICIENT_ARG_PAIRS_MESSAGE, "code": INVALID_REQUEST}
+        else:
+            result = {}
+            valid.append((result, request))
+        results.append(result)
+    if is_admin:
+        scores = [42] * len(valid)
+    else:
+        scores = get_scores_many(store, [request.score_arguments for _, request in valid],
+                                 [request.score_key for _, request in valid])
+    for (result, _), score in zip(valid, scores):
+        result["score"] = score
+    return results
+
+
+# verified (account, login) -> token digest, only tokens which matched are added
+_auth_digests = {}
+# (minute, digest) of the admin token; the token changes with the local
+# hour, checking it once a minute also follows half-hour time zones
+_admin_digest = (None, None)
+
+
+def get_admin_digest():
+    global _admin_digest
+    minute = int(time.time()) // 60
+    cached_minute, digest = _admin_digest
+    if cached_minute != minute:
+        digest = hashlib.sha512(datetime.datetime.now().strftime("%Y%m%d%H") + ADMIN_SALT).hexdigest()
+        _admin_digest = (minute, digest)
+    return digest
+
+
+def get_user_digest(account, login):
+    digest = _auth_digests.get((account, login))
+    if digest is None:
+        digest = hashlib.sha512(account + login + SALT).hexdigest()
+    return digest
 
 
+@metrics.timed_function("check_auth")
 def check_auth(request):
+    token = request.token
+    if isinstance(token, unicode):
+        try:
+            token = token.encode("ascii")
+        except UnicodeEncodeError:
+            return False
+    if not isinstance(token, str):
+        return False
     if request.is_admin:
-        digest = hashlib.sha512(datetime.datetime.now().strftime("%Y%m%d%H") + ADMIN_SALT).hexdigest()
-    else:
-        digest = hashlib.sha512(request.account + request.login + SALT).hexdigest()
-    if digest == request.token:
-        return True
-    return False
+        return hmac.compare_digest(get_admin_digest(), token)
+    key = (request.account, request.login)
+    digest = get_user_digest(*key)
+    # constant time, does not leak how much of the token matched
+    if not hmac.compare_digest(digest, token):
+        return False
+    if key not in _auth_digests and len(_auth_digests) < AUTH_CACHE_SIZE:
+        _auth_digests[key] = digest
+    return True
 
 
 def method_handler(request, context, store):
-    method_request = MethodRequest(request)
+    with metrics.timed("validate"):
+        method_request = MethodRequest(request["body"])
     response, code = Response(method_request, context, store).get_response()
     return response, code
 
 
+def profile_handler(request, context, store):
+    """Dumps the profile aggregated by this process, admin only."""
+    method_request = MethodRequest(request["body"])
+    if method_request.invalid_fields or not method_request.is_admin or not check_auth(method_request):
+        return ERRORS[FORBIDDEN], FORBIDDEN
+    path, requests = profiling.dump()
+    return {"path": path, "requests": requests, "pid": os.getpid()}, OK
+
+
+
+def get_request_id(headers):
+    return headers.get('HTTP_X_REQUEST_ID', uuid.uuid4().hex)
+
+
+def handle_request(router, path, headers, data_string, store):
+    """Route a raw POST body and build the response envelope.
+
+    Shared by MainHTTPHandler and the event loop server, returns (code, envelope).
+    """
+    response, code = {}, OK
+    context = {"request_id": get_request_id(headers)}
+    request = None
+    try:
+        with metrics.timed("parse"):
+            request = serializers.loads(data_string)
+    except:
+        code = BAD_REQUEST
+
+    if request:
+        if logs.should_log_body():
+            logging.info("request", extra={"fields": {
+                "path": path, "request_id": context["request_id"],
+                "body": logs.truncate(data_string, logs.BODY_LIMIT)}})
+        path = path.strip("/")
+        if path in router:
+            try:
+                with profiling.profiled(context["request_id"]) as sampled:
+                    response, code = router[path]({"body": request, "headers": headers}, context, store)
+                if sampled:
+                    context["profiled"] = True
+            except Exception as e:
+                logging.exception("Unexpected error: %s" % e)
+                code = INTERNAL_ERROR
+        else:
+            code = NOT_FOUND
+
+    if code not in ERRORS:
+        r = {"response": response, "code": code}
+    else:
+        r = {"error": response or ERRORS.get(code, "Unknown Error"), "code": code}
+    context.update(r)
+    logging.info("response", extra={"fields": context})
+    return code, r
+
+
 
 class MainHTTPHandler(BaseHTTPRequestHandler):
     router = {
         "method": method_handler
     }
     store = Store()
+    # persistent connections, closed after `timeout` idle seconds
+    protocol_version = "HTTP/1.1"
+    timeout = KEEPALIVE_TIMEOUT
+    max_requests = MAX_REQUESTS_PER_CONNECTION
+    # the status line, headers and body leave in one segment when the
+    # handler flushes, instead of stalling on Nagle and delayed ACKs
+    wbufsize = -1
+    disable_nagle_algorithm = True
+
+    def setup(self):
+        BaseHTTPRequestHandler.setup(self)
+        self.requests_served = 0
 
     def get_request_id(self, headers):
-        return headers.get('HTTP_X_REQUEST_ID', uuid.uuid4().hex)
+        return get_request_id(headers)
+
+    def log_message(self, format, *args):
+        # the access log goes through the logging queue instead of stderr
+        logging.debug("%s - %s" % (self.client_address[0], format % args))
+
+    def do_GET(self):
+        self.requests_served += 1
+        if self.path.partition("?")[0] == metrics.PATH:
+            self.send_body(OK, metrics.render(), metrics.CONTENT_TYPE)
+        else:
+            self.send_body(NOT_FOUND, serializers.dumps({"error": ERRORS[NOT_FOUND], "code": NOT_FOUND}))
 
     def do_POST(self):
-        response, code = {}, OK
-        context = {"request_id": self.get_request_id(self.headers)}
-        request = None
+        self.requests_served += 1
         try:
-            data_string = self.rfile.read(int(self.headers['Content-Length']))
-            request = json.loads(data_string)
+            with metrics.timed("read_body"):
+                data_string = self.rfile.read(int(self.headers['Content-Length']))
         except:
-            code = BAD_REQUEST
-
-        if request:
-            path = self.path.strip("/")
-            logging.info("%s: %s %s" % (self.path, data_string, context["request_id"]))
-            if path in self.router:
-                try:
-                    response, code = self.router[path]({"body": request, "headers": self.headers}, context, self.store)
-                except Exception as e:
-                    logging.exception("Unexpected error: %s" % e)
-                    code = INTERNAL_ERROR
-            else:
-                code = NOT_FOUND
-
+            data_string = None
+            # the rest of the body is still on the wire
+            self.close_connection = 1
+        code, r = handle_request(self.router, self.path, self.headers, data_string, self.store)
+        with metrics.timed("serialize"):
+            body = serializers.dumps(r)
+        self.send_body(code, body)
+
+    def send_body(self, code, body, content_type="application/json"):
         self.send_response(code)
-        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        if self.requests_served >= self.max_requests:
+            self.close_connection = 1
+        if self.close_connection:
+            self.send_header("Connection", "close")
         self.end_headers()
-        if code not in ERRORS:
-            r = {"response": response, "code": code}
-        else:
-            r = {"error": response or ERRORS.get(code, "Unknown Error"), "code": code}
-        context.update(r)
-        logging.info(context)
-        self.wfile.write(json.dumps(r))
-        return
+        self.wfile.write(body)
 
 
 
+class ThreadPoolHTTPServer(HTTPServer):
+    """HTTPServer that serves accepted connections on a bounded pool of threads.
+
+    The pool is started lazily in serve_forever so that it is created in
+    each pre-forked worker process rather than in the parent.
+    """
+
+    def __init__(self, server_address, handler_class, threads):
+        HTTPServer.__init__(self, server_address, handler_class)
+        self.threads = threads
+        self.requests = Queue.Queue(maxsize=threads * PENDING_CONNECTIONS_PER_THREAD)
+        self.workers = []
+
+    def start_workers(self):
+        while len(self.workers) < self.threads:
+            worker = threading.Thread(target=self.process_request_thread)
+            worker.daemon = True
+            worker.start()
+            self.workers.append(worker)
+
+    def serve_forever(self, poll_interval=0.5):
+        self.start_workers()
+        HTTPServer.serve_forever(self, poll_interval)
+
+    def process_request(self, request, client_address):
+        # blocks the accept loop while the queue is full, which leaves
+        # the excess connections in the listen backlog
+        self.requests.put((request, client_address))
+
+    def process_request_thread(self):
+        while True:
+            request, client_address = self.requests.get()
+            if request is None:
+                return
+            try:
+                self.finish_request(request, client_address)
+            except Exception:
+                self.handle_error(request, client_address)
+            finally:
+                self.shutdown_request(request)
+
+    def server_close(self):
+        HTTPServer.server_close(self)
+        for _ in self.workers:
+            self.requests.put((None, None))
+        self.workers = []
+
+
+class SerialHTTPServer(HTTPServer):
+    """HTTPServer that serves one connection at a time.
+
+    An idle keep-alive client would hold up every other one, so the
+    handler answers HTTP/1.0 and closes the connection after each response.
+    """
+
+    def __init__(self, server_address, handler_class):
+        # a class statement, the handlers are classic classes
+        class ClosingHandler(handler_class):
+            protocol_version = "HTTP/1.0"
+
+        HTTPServer.__init__(self, server_address, ClosingHandler)
+
+
+def make_server(port, threads=0, handler_class=MainHTTPHandler):
+    if threads > 0:
+        return ThreadPoolHTTPServer(("localhost", port), handler_class, threads)
+    return SerialHTTPServer(("localhost", port), handler_class)
+
+
+def _raise_keyboard_interrupt(signum, frame):
+    raise KeyboardInterrupt
+
+
+def _signal_children(children, signum):
+    for pid in children:
+        try:
+            os.kill(pid, signum)
+        except OSError:
+            pass
+
+
+def _wait(pid):
+    while True:
+        try:
+            return os.waitpid(pid, 0)
+        except OSError as e:
+            # interrupted by a signal the parent handles
+            if e.errno != errno.EINTR:
+                raise
+
+
+def serve(server, workers=1):
+    """Run the server in this process or in `workers` pre-forked processes
+    which share the listening socket."""
+    if workers <= 1:
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        return
+    children = []
+    for _ in range(workers):
+        pid = os.fork()
+        if pid == 0:
+            try:
+                server.serve_forever()
+            except KeyboardInterrupt:
+                pass
+            finally:
+                # flushes the log queue of this worker
+                logging.shutdown()
+                os._exit(0)
+        children.append(pid)
+    logging.info("Started workers %s" % children)
+    signal.signal(signal.SIGTERM, _raise_keyboard_interrupt)
+    if profiling.enabled():
+        # a profile dump requested from the parent dumps every worker
+        signal.signal(profiling.DUMP_SIGNAL, lambda signum, frame: _signal_children(children, signum))
+    try:
+        for pid in children:
+            _wait(pid)
+    except KeyboardInterrupt:
+        _signal_children(children, signal.SIGTERM)
+
+
 def log_errors(message):
-    print message
+    logging.debug(message)
     # op = OptionParser()
     # op.add_option("-p", "--port", action="store", type=int, default=8080)
     # op.add_option("-l", "--log", action="store", default=None)
@@ -396,14 +784,28 @@ def log_errors(message):
 if __name__ == "__main__":
     op = OptionParser()
     op.add_option("-p", "--port", action="store", type=int, default=8080)
-    op.add_option("-l", "--log", action="store", default=None)
+    add_logging_options(op)
+    op.add_option("-w", "--workers", action="store", type=int, default=1,
+                  help="number of pre-forked processes sharing the socket")
+    op.add_option("-t", "--threads", action="store", type=int, default=0,
+                  help="size of the thread pool per process, 0 to serve serially without keep-alive")
+    op.add_option("--keepalive-timeout", action="store", type=float, default=KEEPALIVE_TIMEOUT,
+                  help="seconds an idle connection is kept open by the thread pool")
+    op.add_option("--max-requests", action="store", type=int, default=MAX_REQUESTS_PER_CONNECTION,
+                  help="requests served on a connection before it is closed")
+    add_store_options(op)
+    add_scoring_options(op)
+    add_profiling_options(op)
     (opts, args) = op.parse_args()
-    logging.basicConfig(filename=opts.log, level=logging.INFO,
-                        format='[%(asctime)s] %(levelname).1s %(message)s', datefmt='%Y.%m.%d %H:%M:%S')
-    server = HTTPServer(("localhost", opts.port), MainHTTPHandler)
-    logging.info("Starting server at %s" % opts.port)
-    try:
-        server.serve_forever()
-    except KeyboardInterrupt:
-        pass
+    log_handler = logging_from_options(opts)
+    scoring_from_options(opts)
+    if profiling_from_options(opts):
+        MainHTTPHandler.router = dict(MainHTTPHandler.router, profile=profile_handler)
+    MainHTTPHandler.store = store_from_options(opts)
+    MainHTTPHandler.timeout = opts.keepalive_timeout
+    MainHTTPHandler.max_requests = opts.max_requests
+    server = make_server(opts.port, opts.threads)
+    logging.info("Starting server at %s (workers: %s, threads: %s)" % (opts.port, opts.workers, opts.threads))
+    serve(server, opts.workers)
     server.server_close()
+    log_handler.close()
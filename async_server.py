@@ -0,0 +1,279 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import asyncore
+import asynchat
+import collections
+import logging
+import mimetools
+import socket
+import time
+import threading
+import Queue
+from cStringIO import StringIO
+from optparse import OptionParser
+
+import api
+import metrics
+import serializers
+from logs import add_logging_options, logging_from_options
+from profiling import add_profiling_options, profiling_from_options
+from scoring import add_scoring_options, scoring_from_options
+from store import add_store_options, store_from_options
+
+
+MAX_HEADER_SIZE = 64 * 1024
+RESPONSE_TEMPLATE = ("HTTP/1.1 %s %s\r\nContent-Type: %s\r\nContent-Length: %s\r\n"
+                     "Connection: %s\r\n\r\n%s")
+REASONS = {api.OK: "OK"}
+REASONS.update(api.ERRORS)
+
+
+class Waker(asyncore.dispatcher):
+    """Lets worker threads schedule callbacks on the event loop thread."""
+
+    def __init__(self, map):
+        reader, self.writer = socket.socketpair()
+        self.writer.setblocking(False)
+        asyncore.dispatcher.__init__(self, reader, map=map)
+        self.callbacks = collections.deque()
+
+    def call_soon(self, callback, *args):
+        self.callbacks.append((callback, args))
+        try:
+            self.writer.send("x")
+        except socket.error:
+            # the loop is already due to wake up
+            pass
+
+    def writable(self):
+        return False
+
+    def handle_read(self):
+        try:
+            self.recv(4096)
+        except socket.error:
+            pass
+        while self.callbacks:
+            callback, args = self.callbacks.popleft()
+            callback(*args)
+
+    def handle_close(self):
+        self.writer.close()
+        self.close()
+
+
+
+class HTTPChannel(asynchat.async_chat):
+    """A single, possibly kept-alive, client connection parsed on the event loop.
+
+    The channel stops reading while its request is being processed, so
+    pipelined requests wait in the socket buffer.
+    """
+
+    def __init__(self, server, sock, map):
+        asynchat.async_chat.__init__(self, sock, map=map)
+        self.server = server
+        self.requests_served = 0
+        self.reset()
+
+    def reset(self):
+        self.buffer = []
+        self.received = 0
+        self.body_started = None
+        self.path = None
+        self.headers = None
+        self.keep_alive = False
+        self.busy = False
+        self.last_activity = time.time()
+        self.set_terminator("\r\n\r\n")
+
+    def readable(self):
+        return not self.busy
+
+    def collect_incoming_data(self, data):
+        self.last_activity = time.time()
+        self.received += len(data)
+        if self.headers is None and self.received > MAX_HEADER_SIZE:
+            self.respond(api.BAD_REQUEST, {"error": api.ERRORS[api.BAD_REQUEST], "code": api.BAD_REQUEST})
+            return
+        self.buffer.append(data)
+
+    def found_terminator(self):
+        data, self.buffer = "".join(self.buffer), []
+        if self.headers is not None:
+            metrics.STAGES.observe("read_body", time.time() - self.body_started)
+            self.submit(data)
+            return
+        request_line, _, header_lines = data.partition("\r\n")
+        try:
+            command, self.path, version = request_line.split()
+        except ValueError:
+            self.respond(api.BAD_REQUEST, {"error": api.ERRORS[api.BAD_REQUEST], "code": api.BAD_REQUEST})
+            return
+        self.headers = mimetools.Message(StringIO(header_lines + "\r\n\r\n"))
+        connection = self.headers.get("Connection", "").lower()
+        if version == "HTTP/1.1":
+            self.keep_alive = connection != "close"
+        else:
+            self.keep_alive = connection == "keep-alive"
+        if command == "GET" and self.path.partition("?")[0] == metrics.PATH:
+            self.send_body(api.OK, metrics.render(), metrics.CONTENT_TYPE)
+            return
+        if command != "POST":
+            self.keep_alive = False
+            self.respond(api.NOT_FOUND, {"error": api.ERRORS[api.NOT_FOUND], "code": api.NOT_FOUND})
+            return
+        try:
+            length = int(self.headers['Content-Length'])
+        except (TypeError, ValueError):
+            length = 0
+        if length > 0:
+            self.body_started = time.time()
+            self.set_terminator(length)
+        else:
+            self.submit(None)
+
+    def submit(self, data_string):
+        self.set_terminator(None)
+        self.busy = True
+        self.server.submit(self, data_string)
+
+    def respond(self, code, r):
+        if not self.connected:
+            # the client went away while the request was processed
+            return
+        with metrics.timed("serialize"):
+            body = serializers.dumps(r)
+        self.send_body(code, body)
+
+    def send_body(self, code, body, content_type="application/json"):
+        self.requests_served += 1
+        keep_alive = self.keep_alive and self.requests_served < self.server.max_requests
+        self.push(RESPONSE_TEMPLATE % (code, REASONS.get(code, ""), content_type, len(body),
+                                       "keep-alive" if keep_alive else "close", body))
+        if keep_alive:
+            self.reset()
+        else:
+            self.busy = True
+            self.close_when_done()
+
+    def is_idle(self, now):
+        return not self.busy and now - self.last_activity > self.server.keepalive_timeout
+
+
+
+class AsyncHTTPServer(asyncore.dispatcher):
+    """Event loop HTTP server for the api router.
+
+    Connections are multiplexed on one thread, so idle and in-flight
+    connections cost no threads. Requests are handled by `threads` worker
+    threads which bound the number of concurrent Store round-trips.
+    """
+
+    def __init__(self, server_address, threads, router=None, store=None,
+                 keepalive_timeout=api.KEEPALIVE_TIMEOUT, max_requests=api.MAX_REQUESTS_PER_CONNECTION):
+        self.map = {}
+        asyncore.dispatcher.__init__(self, map=self.map)
+        self.create_socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.set_reuse_addr()
+        self.bind(server_address)
+        self.listen(socket.SOMAXCONN)
+        self.server_address = self.socket.getsockname()
+        self.threads = threads
+        self.keepalive_timeout = keepalive_timeout
+        self.max_requests = max_requests
+        self.router = api.MainHTTPHandler.router if router is None else router
+        self.store = api.MainHTTPHandler.store if store is None else store
+        self.jobs = Queue.Queue()
+        self.workers = []
+        self.waker = None
+        self.stopped = threading.Event()
+
+    def start_workers(self):
+        # started in serve_forever so pre-forked processes get their own
+        if self.waker is None:
+            self.waker = Waker(self.map)
+        while len(self.workers) < self.threads:
+            worker = threading.Thread(target=self.process_request_thread)
+            worker.daemon = True
+            worker.start()
+            self.workers.append(worker)
+
+    def handle_accept(self):
+        pair = self.accept()
+        if pair is not None:
+            HTTPChannel(self, pair[0], self.map)
+
+    def submit(self, channel, data_string):
+        self.jobs.put((channel, data_string))
+
+    def process_request_thread(self):
+        while True:
+            channel, data_string = self.jobs.get()
+            if channel is None:
+                return
+            try:
+                code, r = api.handle_request(self.router, channel.path, channel.headers, data_string, self.store)
+            except Exception as e:
+                logging.exception("Unexpected error: %s" % e)
+                code, r = api.INTERNAL_ERROR, {"error": api.ERRORS[api.INTERNAL_ERROR], "code": api.INTERNAL_ERROR}
+            self.waker.call_soon(channel.respond, code, r)
+
+    def serve_forever(self, poll_interval=0.5):
+        self.start_workers()
+        self.stopped.clear()
+        swept = time.time()
+        while not self.stopped.is_set():
+            asyncore.loop(timeout=poll_interval, map=self.map, count=1)
+            now = time.time()
+            if now - swept >= 1:
+                self.close_idle_channels(now)
+                swept = now
+
+    def close_idle_channels(self, now):
+        for channel in self.map.values():
+            if isinstance(channel, HTTPChannel) and channel.is_idle(now):
+                channel.close()
+
+    def shutdown(self):
+        self.stopped.set()
+        if self.waker is not None:
+            self.waker.call_soon(lambda: None)
+
+    def server_close(self):
+        for _ in self.workers:
+            self.jobs.put((None, None))
+        self.workers = []
+        asyncore.close_all(map=self.map)
+        self.waker = None
+
+
+if __name__ == "__main__":
+    op = OptionParser()
+    op.add_option("-p", "--port", action="store", type=int, default=8080)
+    add_logging_options(op)
+    op.add_option("-w", "--workers", action="store", type=int, default=1,
+                  help="number of pre-forked processes sharing the socket")
+    op.add_option("-t", "--threads", action="store", type=int, default=16,
+                  help="number of concurrently handled requests per process")
+    op.add_option("--keepalive-timeout", action="store", type=float, default=api.KEEPALIVE_TIMEOUT,
+                  help="seconds an idle connection is kept open")
+    op.add_option("--max-requests", action="store", type=int, default=api.MAX_REQUESTS_PER_CONNECTION,
+                  help="requests served on a connection before it is closed")
+    add_store_options(op)
+    add_scoring_options(op)
+    add_profiling_options(op)
+    (opts, args) = op.parse_args()
+    log_handler = logging_from_options(opts)
+    scoring_from_options(opts)
+    router = None
+    if profiling_from_options(opts):
+        router = dict(api.MainHTTPHandler.router, profile=api.profile_handler)
+    server = AsyncHTTPServer(("localhost", opts.port), opts.threads, router=router,
+                             store=store_from_options(opts), keepalive_timeout=opts.keepalive_timeout,
+                             max_requests=opts.max_requests)
+    logging.info("Starting event loop server at %s (workers: %s, threads: %s)" % (opts.port, opts.workers, opts.threads))
+    api.serve(server, opts.workers)
+    server.server_close()
+    log_handler.close()
@@ -0,0 +1,232 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Load test for the /method/ endpoint.
+
+    python benchmark.py --concurrency 16 --duration 10 --mix online_score=60,client_interests=30,admin=5,invalid=5
+
+Starts the server in-process against an in-memory store (or the --store
+backend) or targets a running one with --target host:port, drives the
+request mix from `concurrency` keep-alive clients and writes RPS and
+latency percentiles as JSON to --output.
+"""
+
+import sys
+import json
+import math
+import time
+import random
+import hashlib
+import datetime
+import httplib
+import threading
+from optparse import OptionParser
+
+import api
+import serializers
+from async_server import AsyncHTTPServer
+from store import add_store_options, store_from_options
+
+
+DEFAULT_MIX = "online_score=60,client_interests=30,admin=5,invalid=5"
+CLIENT_IDS = 1000
+INTERESTS = ["cars", "pets", "travel", "hi-tech", "sport", "music", "books", "tv", "cinema", "geek", "otus"]
+
+
+def seed_interests(store, count=CLIENT_IDS, seed=0, format="json"):
+    rand = random.Random(seed)
+    for cid in range(1, count + 1):
+        store.set("i:%s" % cid, serializers.encode_interests(rand.sample(INTERESTS, 2), format))
+
+
+def user_request(method, arguments, login="h&f", account="horns&hoofs"):
+    if login == api.ADMIN_LOGIN:
+        token = hashlib.sha512(datetime.datetime.now().strftime("%Y%m%d%H") + api.ADMIN_SALT).hexdigest()
+    else:
+        token = hashlib.sha512(account + login + api.SALT).hexdigest()
+    return {"account": account, "login": login, "method": method, "token": token, "arguments": arguments}
+
+
+def online_score_body(rand):
+    arguments = {"phone": "7%010d" % rand.randint(0, 10 ** 10 - 1), "email": "user%s@otus.ru" % rand.randint(0, 10 ** 6),
+                 "first_name": "name%s" % rand.randint(0, 10 ** 4), "last_name": "surname",
+                 "birthday": "%02d.%02d.%s" % (rand.randint(1, 28), rand.randint(1, 12), rand.randint(1960, 2010)),
+                 "gender": rand.randint(0, 2)}
+    return user_request("online_score", arguments)
+
+
+def client_interests_body(rand):
+    arguments = {"client_ids": rand.sample(range(1, CLIENT_IDS + 1), rand.randint(1, 10)),
+                 "date": "20.07.2017"}
+    return user_request("client_interests", arguments)
+
+
+def admin_body(rand):
+    return user_request("online_score", {"phone": "79175002040", "email": "stupnikov@otus.ru"}, login=api.ADMIN_LOGIN)
+
+
+def invalid_body(rand):
+    return user_request("online_score", {"phone": "89175002040", "email": "stupnikovotus.ru", "gender": -1})
+
+
+BODIES = {
+    "online_score": online_score_body,
+    "client_interests": client_interests_body,
+    "admin": admin_body,
+    "invalid": invalid_body,
+}
+
+
+def parse_mix(mix):
+    weights = []
+    for part in mix.split(","):
+        kind, _, weight = part.partition("=")
+        if kind not in BODIES:
+            raise ValueError("Unknown request kind %r, expected one of %s" % (kind, ", ".join(sorted(BODIES))))
+        weights.append((kind, float(weight or 1)))
+    return weights
+
+
+def choose(rand, weights, total):
+    point = rand.uniform(0, total)
+    for kind, weight in weights:
+        point -= weight
+        if point <= 0:
+            return kind
+    return weights[-1][0]
+
+
+def percentile(sorted_values, fraction):
+    """Nearest-rank percentile of an already sorted list."""
+    if not sorted_values:
+        return None
+    index = max(int(math.ceil(fraction * len(sorted_values))) - 1, 0)
+    return sorted_values[min(index, len(sorted_values) - 1)]
+
+
+def summarize(latencies, elapsed, errors=0):
+    latencies = sorted(latencies)
+    return {
+        "requests": len(latencies),
+        "errors": errors,
+        "rps": len(latencies) / elapsed if elapsed else 0,
+        "p50_ms": percentile(latencies, 0.50) * 1000 if latencies else None,
+        "p95_ms": percentile(latencies, 0.95) * 1000 if latencies else None,
+        "p99_ms": percentile(latencies, 0.99) * 1000 if latencies else None,
+        "max_ms": latencies[-1] * 1000 if latencies else None,
+    }
+
+
+class Client(threading.Thread):
+    """Sends requests over one keep-alive connection until the deadline or request budget."""
+
+    def __init__(self, host, port, weights, deadline, budget, seed):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.host, self.port = host, port
+        self.weights = weights
+        self.total_weight = sum(weight for _, weight in weights)
+        self.deadline = deadline
+        self.budget = budget
+        self.rand = random.Random(seed)
+        self.latencies = dict((kind, []) for kind, _ in weights)
+        self.errors = dict((kind, 0) for kind, _ in weights)
+
+    def run(self):
+        conn = httplib.HTTPConnection(self.host, self.port, timeout=30)
+        sent = 0
+        while time.time() < self.deadline and (self.budget is None or sent < self.budget):
+            kind = choose(self.rand, self.weights, self.total_weight)
+            body = json.dumps(BODIES[kind](self.rand))
+            started = time.time()
+            try:
+                conn.request("POST", "/method/", body, {"Content-Type": "application/json"})
+                response = conn.getresponse()
+                response.read()
+                if response.status >= api.INTERNAL_ERROR:
+                    self.errors[kind] += 1
+            except (httplib.HTTPException, IOError):
+                self.errors[kind] += 1
+                conn.close()
+                conn = httplib.HTTPConnection(self.host, self.port, timeout=30)
+            self.latencies[kind].append(time.time() - started)
+            sent += 1
+        conn.close()
+
+
+def run(host, port, weights, concurrency=8, duration=10.0, requests=None, seed=0):
+    """Drives the mix against host:port, returns the report dict."""
+    deadline = time.time() + duration
+    budget = None if requests is None else max(requests // concurrency, 1)
+    clients = [Client(host, port, weights, deadline, budget, seed + i) for i in range(concurrency)]
+    started = time.time()
+    for client in clients:
+        client.start()
+    for client in clients:
+        client.join()
+    elapsed = time.time() - started
+    report = {"concurrency": concurrency, "elapsed": elapsed, "mix": dict(weights), "kinds": {}}
+    everything, errors = [], 0
+    for kind, _ in weights:
+        latencies = [latency for client in clients for latency in client.latencies[kind]]
+        kind_errors = sum(client.errors[kind] for client in clients)
+        report["kinds"][kind] = summarize(latencies, elapsed, kind_errors)
+        everything.extend(latencies)
+        errors += kind_errors
+    report["total"] = summarize(everything, elapsed, errors)
+    return report
+
+
+def start_server(kind, threads, store):
+    if kind == "event_loop":
+        server = AsyncHTTPServer(("localhost", 0), threads, store=store)
+    else:
+        class BenchmarkHandler(api.MainHTTPHandler):
+            pass
+        BenchmarkHandler.store = store
+        server = api.make_server(0, threads, BenchmarkHandler)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return server
+
+
+if __name__ == "__main__":
+    op = OptionParser()
+    op.add_option("-c", "--concurrency", action="store", type=int, default=8)
+    op.add_option("-d", "--duration", action="store", type=float, default=10.0, help="seconds")
+    op.add_option("-n", "--requests", action="store", type=int, default=None,
+                  help="total requests, stops at the duration anyway")
+    op.add_option("-m", "--mix", action="store", default=DEFAULT_MIX)
+    op.add_option("--server", action="store", choices=["threads", "event_loop"], default="threads")
+    op.add_option("-t", "--threads", action="store", type=int, default=8,
+                  help="server threads of the in-process server")
+    op.add_option("--target", action="store", default=None,
+                  help="host:port of a running server instead of the in-process one")
+    op.add_option("--seed", action="store", type=int, default=0)
+    op.add_option("--interests-format", action="store", choices=serializers.INTERESTS_FORMATS, default="json",
+                  help="encoding of the interests seeded into the in-process store")
+    op.add_option("-o", "--output", action="store", default=None, help="JSON report, stdout by default")
+    add_store_options(op)
+    op.set_defaults(store="memory")
+    (opts, args) = op.parse_args()
+    weights = parse_mix(opts.mix)
+    server = None
+    if opts.target:
+        host, _, port = opts.target.partition(":")
+        port = int(port)
+    else:
+        store = store_from_options(opts)
+        seed_interests(store, seed=opts.seed, format=opts.interests_format)
+        server = start_server(opts.server, opts.threads, store)
+        host, port = "localhost", server.server_address[1]
+    report = run(host, port, weights, opts.concurrency, opts.duration, opts.requests, opts.seed)
+    report["server"] = opts.target or opts.server
+    report["store"] = None if opts.target else opts.store
+    if server is not None:
+        server.shutdown()
+        server.server_close()
+    output = open(opts.output, "w") if opts.output else sys.stdout
+    json.dump(report, output, indent=2, sort_keys=True)
+    output.write("\n")
+    if opts.output:
+        output.close()
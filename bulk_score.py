@@ -0,0 +1,127 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Scores a JSONL stream of online_score arguments offline.
+
+    python bulk_score.py -i requests.jsonl -o scores.jsonl --processes 8
+
+Every non-empty input line produces one output line in the same order, either
+{"score": ...} or {"error": ..., "code": ...}.
+"""
+
+import sys
+import json
+import time
+import logging
+import itertools
+import collections
+import multiprocessing
+from optparse import OptionParser
+
+import api
+from scoring import add_scoring_options, scoring_from_options
+from store import add_store_options, store_from_options
+
+
+# the store of a worker process, created by init_worker
+_store = None
+
+
+def init_worker(store_factory, *args):
+    global _store
+    _store = store_factory(*args)
+
+
+def score_lines(lines):
+    """Scores a batch of JSONL lines against the worker's store, returns the output lines."""
+    results = [None] * len(lines)
+    items, positions = [], []
+    for position, line in enumerate(lines):
+        try:
+            arguments = json.loads(line)
+        except ValueError:
+            arguments = None
+        if not isinstance(arguments, dict):
+            results[position] = {"error": api.ERRORS[api.BAD_REQUEST], "code": api.BAD_REQUEST}
+            continue
+        items.append(arguments)
+        positions.append(position)
+    for position, result in zip(positions, api.score_items(_store, items)):
+        results[position] = result
+    return [json.dumps(result) + "\n" for result in results]
+
+
+def read_batches(lines, batch_size):
+    lines = (line for line in lines if line.strip())
+    while True:
+        batch = list(itertools.islice(lines, batch_size))
+        if not batch:
+            return
+        yield batch
+
+
+def imap_bounded(pool, func, iterable, window):
+    """Ordered pool.imap which keeps at most `window` tasks in flight,
+    so the input is never read ahead of the output."""
+    pending = collections.deque()
+    for item in iterable:
+        pending.append(pool.apply_async(func, (item,)))
+        if len(pending) >= window:
+            yield pending.popleft().get()
+    while pending:
+        yield pending.popleft().get()
+
+
+def run(input_file, output_file, store_factory, store_args=(), processes=1, batch_size=500,
+        progress_interval=10):
+    """Streams input_file through the scorer into output_file, returns the number of rows."""
+    batches = read_batches(input_file, batch_size)
+    pool = None
+    if processes > 1:
+        pool = multiprocessing.Pool(processes, init_worker, (store_factory,) + tuple(store_args))
+        scored = imap_bounded(pool, score_lines, batches, processes * 2)
+    else:
+        init_worker(store_factory, *store_args)
+        scored = itertools.imap(score_lines, batches)
+    rows, started = 0, time.time()
+    reported = started
+    try:
+        for lines in scored:
+            output_file.writelines(lines)
+            rows += len(lines)
+            now = time.time()
+            if progress_interval and now - reported >= progress_interval:
+                logging.info("%s rows, %.0f rows/s" % (rows, rows / (now - started)))
+                reported = now
+    finally:
+        if pool is not None:
+            pool.terminate()
+            pool.join()
+    elapsed = time.time() - started
+    logging.info("Scored %s rows in %.1fs, %.0f rows/s" % (rows, elapsed, rows / elapsed if elapsed else 0))
+    return rows
+
+
+if __name__ == "__main__":
+    op = OptionParser()
+    op.add_option("-i", "--input", action="store", default=None, help="JSONL file, stdin by default")
+    op.add_option("-o", "--output", action="store", default=None, help="JSONL file, stdout by default")
+    op.add_option("-P", "--processes", action="store", type=int, default=multiprocessing.cpu_count())
+    op.add_option("-b", "--batch-size", action="store", type=int, default=500,
+                  help="rows per worker task and per redis round-trip")
+    op.add_option("--progress", action="store", type=float, default=10,
+                  help="seconds between progress reports, 0 disables them")
+    op.add_option("-l", "--log", action="store", default=None)
+    add_store_options(op)
+    add_scoring_options(op)
+    (opts, args) = op.parse_args()
+    # before the pool forks, so the workers score the way the servers do
+    scoring_from_options(opts)
+    logging.basicConfig(filename=opts.log, level=logging.INFO,
+                        format='[%(asctime)s] %(levelname).1s %(message)s', datefmt='%Y.%m.%d %H:%M:%S')
+    input_file = open(opts.input) if opts.input else sys.stdin
+    output_file = open(opts.output, "w") if opts.output else sys.stdout
+    try:
+        run(input_file, output_file, store_from_options, (opts,), opts.processes, opts.batch_size, opts.progress)
+    finally:
+        input_file.close()
+        output_file.close()
@@ -0,0 +1,149 @@
+import sys
+import time
+import threading
+from collections import OrderedDict
+
+
+class LRUCache(object):
+    """Thread-safe LRU cache bounded by entries and approximate bytes, with per-entry TTL.
+
+    `ttl` is the default lifetime in seconds, None keeps entries until evicted.
+    """
+
+    def __init__(self, max_entries=10000, max_bytes=None, ttl=None):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __contains__(self, key):
+        return self.get_with_ttl(key, count=False)[1] is not None
+
+    def get(self, key, default=None):
+        value, ttl = self.get_with_ttl(key)
+        return default if ttl is None else value
+
+    def get_with_ttl(self, key, count=True):
+        """Returns (value, seconds left), (None, None) when missing or expired.
+
+        Entries without a lifetime report float("inf") seconds left.
+        """
+        with self.lock:
+            entry = self.entries.pop(key, None)
+            if entry is None:
+                if count:
+                    self.misses += 1
+                return None, None
+            value, expires_at, size = entry
+            now = time.time()
+            if expires_at is not None and expires_at <= now:
+                self.bytes -= size
+                self.expirations += 1
+                if count:
+                    self.misses += 1
+                return None, None
+            # re-inserted as the most recently used entry
+            self.entries[key] = entry
+            if count:
+                self.hits += 1
+            return value, float("inf") if expires_at is None else expires_at - now
+
+    def set(self, key, value, ttl=None):
+        ttl = self.ttl if ttl is None else ttl
+        if ttl is not None and ttl <= 0:
+            self.delete(key)
+            return
+        size = sys.getsizeof(key) + sys.getsizeof(value)
+        if self.max_bytes is not None and size > self.max_bytes:
+            self.delete(key)
+            return
+        expires_at = time.time() + ttl if ttl is not None else None
+        with self.lock:
+            previous = self.entries.pop(key, None)
+            if previous is not None:
+                self.bytes -= previous[2]
+            self.entries[key] = (value, expires_at, size)
+            self.bytes += size
+            while len(self.entries) > self.max_entries or \
+                    (self.max_bytes is not None and self.bytes > self.max_bytes):
+                _, (_, _, evicted_size) = self.entries.popitem(last=False)
+                self.bytes -= evicted_size
+                self.evictions += 1
+
+    def delete(self, key):
+        with self.lock:
+            entry = self.entries.pop(key, None)
+            if entry is not None:
+                self.bytes -= entry[2]
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.bytes = 0
+
+    def stats(self):
+        with self.lock:
+            return {
+                "entries": len(self.entries),
+                "bytes": self.bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "expirations": self.expirations,
+            }
+
+
+class _Call(object):
+    def __init__(self):
+        # held while the call runs, a plain lock is much cheaper than an Event
+        self.running = threading.Lock()
+        self.running.acquire()
+        self.result = None
+        self.error = None
+
+    def wait(self):
+        self.running.acquire()
+        self.running.release()
+
+
+class SingleFlight(object):
+    """Runs concurrent calls with the same key once.
+
+    The first caller runs the function, callers arriving while it runs wait
+    for it and get its result, or its exception.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.calls = {}
+
+    def do(self, key, func, *args, **kwargs):
+        with self.lock:
+            call = self.calls.get(key)
+            leader = call is None
+            if leader:
+                call = self.calls[key] = _Call()
+        if not leader:
+            call.wait()
+            if call.error is not None:
+                raise call.error[0], call.error[1], call.error[2]
+            return call.result
+        try:
+            call.result = func(*args, **kwargs)
+        except:
+            call.error = sys.exc_info()
+            raise
+        finally:
+            with self.lock:
+                del self.calls[key]
+            call.running.release()
+        return call.result
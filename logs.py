@@ -0,0 +1,166 @@
+import os
+import json
+import random
+import logging
+import threading
+import Queue
+
+
+# fraction of request bodies logged, and the size they are cut to
+BODY_SAMPLE_RATE = 1.0
+BODY_LIMIT = 4096
+# longest logged field value, longer ones are truncated by the writer
+FIELD_LIMIT = 4096
+QUEUE_SIZE = 10000
+
+_traceback_formatter = logging.Formatter()
+
+
+def should_log_body():
+    return BODY_SAMPLE_RATE >= 1 or random.random() < BODY_SAMPLE_RATE
+
+
+def truncate(value, limit):
+    if value is None or len(value) <= limit:
+        return value
+    return "%s...[%s more]" % (value[:limit], len(value) - limit)
+
+
+class JSONFormatter(logging.Formatter):
+    """One JSON object per line; structured fields are passed as extra={"fields": {...}}."""
+
+    def __init__(self, field_limit=FIELD_LIMIT):
+        logging.Formatter.__init__(self)
+        self.field_limit = field_limit
+
+    def bounded(self, value):
+        if isinstance(value, basestring):
+            return truncate(value, self.field_limit)
+        try:
+            encoded = json.dumps(value)
+        except (TypeError, ValueError):
+            # the value itself would fail the line's json.dumps
+            return truncate(repr(value), self.field_limit)
+        if len(encoded) <= self.field_limit:
+            return value
+        return truncate(encoded, self.field_limit)
+
+    def format(self, record):
+        line = {
+            "time": self.formatTime(record, "%Y.%m.%d %H:%M:%S"),
+            "level": record.levelname,
+            "message": record.getMessage(),
+        }
+        for name, value in getattr(record, "fields", {}).iteritems():
+            line[name] = self.bounded(value)
+        if record.exc_info and not record.exc_text:
+            record.exc_text = self.formatException(record.exc_info)
+        if record.exc_text:
+            line["exception"] = record.exc_text
+        return json.dumps(line)
+
+
+class TextFormatter(logging.Formatter):
+    """The classic log line, followed by the structured fields."""
+
+    def __init__(self):
+        logging.Formatter.__init__(self, '[%(asctime)s] %(levelname).1s %(message)s', datefmt='%Y.%m.%d %H:%M:%S')
+
+    def format(self, record):
+        line = logging.Formatter.format(self, record)
+        fields = getattr(record, "fields", None)
+        return "%s %s" % (line, fields) if fields else line
+
+
+class LogWriter(threading.Thread):
+    """Background thread writing the queued records with the target handlers."""
+
+    def __init__(self, queue, handlers):
+        threading.Thread.__init__(self, name="log-writer")
+        self.daemon = True
+        self.queue = queue
+        self.handlers = handlers
+
+    def run(self):
+        while True:
+            record = self.queue.get()
+            if record is None:
+                break
+            for handler in self.handlers:
+                if record.levelno >= handler.level:
+                    handler.handle(record)
+        for handler in self.handlers:
+            handler.flush()
+
+    def stop(self):
+        self.queue.put(None)
+        self.join()
+
+
+class QueueHandler(logging.Handler):
+    """Hands records to a LogWriter thread, drops them when its queue is full.
+
+    The request thread never waits for log I/O. The writer is started on
+    the first record of every process, so pre-forked workers get their own.
+    """
+
+    def __init__(self, handlers, queue_size=QUEUE_SIZE):
+        logging.Handler.__init__(self)
+        self.handlers = handlers
+        self.queue_size = queue_size
+        self.queue = None
+        self.writer = None
+        self.pid = None
+        self.dropped = 0
+
+    def prepare(self, record):
+        # tracebacks can't wait for the writer, and hold on to the frames
+        if record.exc_info:
+            record.exc_text = _traceback_formatter.formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+    def emit(self, record):
+        # called under the handler lock
+        if self.pid != os.getpid():
+            self.queue = Queue.Queue(maxsize=self.queue_size)
+            self.writer = LogWriter(self.queue, self.handlers)
+            self.writer.start()
+            self.pid = os.getpid()
+        try:
+            self.queue.put_nowait(self.prepare(record))
+        except Queue.Full:
+            self.dropped += 1
+
+    def close(self):
+        if self.writer is not None and self.pid == os.getpid():
+            self.writer.stop()
+            self.writer = None
+        logging.Handler.close(self)
+
+
+def setup_logging(filename=None, level=logging.INFO, json_lines=True, queue_size=QUEUE_SIZE):
+    """Routes the root logger through a queue to a background writer, returns the queue handler."""
+    target = logging.FileHandler(filename) if filename else logging.StreamHandler()
+    target.setFormatter(JSONFormatter() if json_lines else TextFormatter())
+    handler = QueueHandler([target], queue_size)
+    root = logging.getLogger()
+    root.setLevel(level)
+    root.addHandler(handler)
+    return handler
+
+
+def add_logging_options(op):
+    op.add_option("-l", "--log", action="store", default=None)
+    op.add_option("--log-format", action="store", choices=["json", "text"], default="json")
+    op.add_option("--log-body-sample", action="store", type=float, default=BODY_SAMPLE_RATE,
+                  help="fraction of request bodies written to the log")
+    op.add_option("--log-body-limit", action="store", type=int, default=BODY_LIMIT,
+                  help="bytes of a request body written to the log")
+
+
+def logging_from_options(opts):
+    global BODY_SAMPLE_RATE, BODY_LIMIT
+    BODY_SAMPLE_RATE = opts.log_body_sample
+    BODY_LIMIT = opts.log_body_limit
+    return setup_logging(opts.log, json_lines=opts.log_format == "json")
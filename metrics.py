@@ -0,0 +1,101 @@
+import os
+import time
+import bisect
+import functools
+import threading
+from contextlib import contextmanager
+
+
+# seconds, fine grained below 10ms where the in-process stages live
+DEFAULT_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+PATH = "/metrics"
+
+
+class Histogram(object):
+    """Thread-safe latency histogram with one series per label value.
+
+    Bucket counts are kept per bucket and made cumulative when rendered
+    in the Prometheus text format.
+    """
+
+    def __init__(self, name, documentation, label, buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.label = label
+        self.buckets = tuple(sorted(buckets))
+        # label value -> [counts per bucket and +Inf, sum]
+        self.series = {}
+        self.lock = threading.Lock()
+
+    def observe(self, label_value, value):
+        index = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            series = self.series.get(label_value)
+            if series is None:
+                series = self.series[label_value] = [[0] * (len(self.buckets) + 1), 0.0]
+            series[0][index] += 1
+            series[1] += value
+
+    def snapshot(self):
+        """Returns {label value: (cumulative counts, sum)}."""
+        with self.lock:
+            series = dict((label_value, (list(counts), total)) for label_value, (counts, total) in self.series.items())
+        result = {}
+        for label_value, (counts, total) in series.items():
+            cumulative, running = [], 0
+            for count in counts:
+                running += count
+                cumulative.append(running)
+            result[label_value] = (cumulative, total)
+        return result
+
+    def clear(self):
+        with self.lock:
+            self.series.clear()
+
+    def render(self):
+        """Every series is labelled with the pid: pre-forked workers count
+        separately, and a scrape reaches whichever one accepts it."""
+        lines = ["# HELP %s %s" % (self.name, self.documentation), "# TYPE %s histogram" % self.name]
+        bounds = ["%g" % bound for bound in self.buckets] + ["+Inf"]
+        pid = os.getpid()
+        for label_value, (cumulative, total) in sorted(self.snapshot().items()):
+            labels = 'pid="%s",%s="%s"' % (pid, self.label, label_value)
+            for bound, count in zip(bounds, cumulative):
+                lines.append('%s_bucket{%s,le="%s"} %d' % (self.name, labels, bound, count))
+            lines.append('%s_sum{%s} %.9f' % (self.name, labels, total))
+            lines.append('%s_count{%s} %d' % (self.name, labels, cumulative[-1]))
+        return "\n".join(lines) + "\n"
+
+
+STAGES = Histogram("api_stage_duration_seconds", "Time spent in each stage of a request.", "stage")
+REGISTRY = [STAGES]
+
+
+@contextmanager
+def timed(stage, histogram=STAGES):
+    """Times the block into `histogram`, also when it raises."""
+    started = time.time()
+    try:
+        yield
+    finally:
+        histogram.observe(stage, time.time() - started)
+
+
+def timed_function(stage, histogram=STAGES):
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            started = time.time()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                histogram.observe(stage, time.time() - started)
+        return wrapper
+    return decorator
+
+
+def render(registry=None):
+    """The metrics of this process in the Prometheus text exposition format."""
+    return "".join(histogram.render() for histogram in (REGISTRY if registry is None else registry))
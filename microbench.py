@@ -0,0 +1,162 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Microbenchmarks of the request validation and scoring hot paths.
+
+    python microbench.py                 # print the results
+    python microbench.py --save          # rewrite microbench_baseline.json
+    python microbench.py --compare       # exit 1 if a case got slower than the baseline
+
+Results are the best of --repeat runs, in microseconds per call.
+"""
+
+import sys
+import json
+import timeit
+import hashlib
+import datetime
+import platform
+from optparse import OptionParser
+
+import api
+import scoring
+from scoring import get_score
+
+
+BASELINE = "microbench_baseline.json"
+# slowdown tolerated by --compare before a case is flagged
+THRESHOLD = 0.25
+
+SCORE_ARGUMENTS = {"phone": "79175002040", "email": "stupnikov@otus.ru", "first_name": "a", "last_name": "b",
+                   "birthday": "01.01.2000", "gender": 1}
+METHOD_ARGUMENTS = {"account": "horns&hoofs", "login": "h&f", "method": "online_score",
+                    "token": hashlib.sha512("horns&hoofs" + "h&f" + api.SALT).hexdigest(),
+                    "arguments": SCORE_ARGUMENTS}
+ADMIN_ARGUMENTS = dict(METHOD_ARGUMENTS, login=api.ADMIN_LOGIN,
+                       token=hashlib.sha512(datetime.datetime.now().strftime("%Y%m%d%H") + api.ADMIN_SALT).hexdigest())
+INTERESTS_ARGUMENTS = {"client_ids": range(1, 11), "date": "20.07.2017"}
+
+
+class Fields(api.BaseRequest):
+    char = api.CharField()
+    email = api.EmailField()
+    phone = api.PhoneField()
+    arguments = api.ArgumentsField()
+    date = api.DateField()
+    birthday = api.BirthDayField()
+    gender = api.GenderField()
+    client_ids = api.ClientIDsField()
+
+
+FIELD_VALUES = {
+    "char": "Stanislav",
+    "email": "stupnikov@otus.ru",
+    "phone": "79175002040",
+    "arguments": SCORE_ARGUMENTS,
+    "date": "20.07.2017",
+    "birthday": "01.01.1990",
+    "gender": 1,
+    "client_ids": range(1, 11),
+}
+
+
+class MissStore(object):
+    def cache_get(self, key):
+        return None
+
+    def cache_set(self, key, val, duration=60*60):
+        pass
+
+
+class HitStore(MissStore):
+    def cache_get(self, key):
+        return "5.0"
+
+
+def field_case(name):
+    instance = Fields({})
+    set_value = Fields.__dict__[name].__set__
+    value = FIELD_VALUES[name]
+    return lambda: set_value(instance, value)
+
+
+def score_case(store):
+    request = api.OnlineScoreRequest(SCORE_ARGUMENTS)
+    return lambda: get_score(store, request.phone, request.email, birthday=request.birthday,
+                             gender=request.gender, first_name=request.first_name, last_name=request.last_name)
+
+
+def key_case():
+    request = api.OnlineScoreRequest(SCORE_ARGUMENTS)
+    return lambda: scoring.get_score_key(request.first_name, request.last_name, request.birthday)
+
+
+def cases():
+    user, admin = api.MethodRequest(METHOD_ARGUMENTS), api.MethodRequest(ADMIN_ARGUMENTS)
+    benchmarks = {
+        "MethodRequest": lambda: api.MethodRequest(METHOD_ARGUMENTS),
+        "OnlineScoreRequest": lambda: api.OnlineScoreRequest(SCORE_ARGUMENTS),
+        "ClientsInterestsRequest": lambda: api.ClientsInterestsRequest(INTERESTS_ARGUMENTS),
+        "check_auth": lambda: api.check_auth(user),
+        "check_auth_admin": lambda: api.check_auth(admin),
+        "get_score_miss": score_case(MissStore()),
+        "get_score_hit": score_case(HitStore()),
+        "get_score_key": key_case(),
+    }
+    for name in FIELD_VALUES:
+        field_class = Fields.__dict__[name].__class__.__name__
+        benchmarks["%s.__set__" % field_class] = field_case(name)
+    return benchmarks
+
+
+def measure(func, number, repeat):
+    return min(timeit.repeat(func, number=number, repeat=repeat)) / number * 1e6
+
+
+def run(number=10000, repeat=5, names=None):
+    benchmarks = cases()
+    return dict((name, measure(func, number, repeat)) for name, func in sorted(benchmarks.items())
+                if names is None or name in names)
+
+
+def compare(results, baseline, threshold=THRESHOLD):
+    """Returns (name, baseline, result, change) for the cases slower than baseline by more than threshold."""
+    slower = []
+    for name, result in sorted(results.items()):
+        before = baseline.get(name)
+        if before is None:
+            continue
+        change = result / before - 1
+        if change > threshold:
+            slower.append((name, before, result, change))
+    return slower
+
+
+if __name__ == "__main__":
+    op = OptionParser()
+    op.add_option("-n", "--number", action="store", type=int, default=10000, help="calls per run")
+    op.add_option("-r", "--repeat", action="store", type=int, default=5, help="runs, the best one counts")
+    op.add_option("--baseline", action="store", default=BASELINE)
+    op.add_option("--save", action="store_true", default=False, help="store the results as the baseline")
+    op.add_option("--compare", action="store_true", default=False, help="compare the results to the baseline")
+    op.add_option("--threshold", action="store", type=float, default=THRESHOLD)
+    (opts, args) = op.parse_args()
+    results = run(opts.number, opts.repeat, set(args) or None)
+    baseline = {}
+    if opts.compare:
+        with open(opts.baseline) as f:
+            baseline = json.load(f)["results"]
+    for name, result in sorted(results.items()):
+        line = "%-28s %10.2f us" % (name, result)
+        if name in baseline:
+            line += "  %+6.1f%%" % ((result / baseline[name] - 1) * 100)
+        print line
+    if opts.save:
+        with open(opts.baseline, "w") as f:
+            json.dump({"python": platform.python_version(), "machine": platform.machine(), "results": results},
+                      f, indent=2, sort_keys=True)
+            f.write("\n")
+    if opts.compare:
+        slower = compare(results, baseline, opts.threshold)
+        for name, before, result, change in slower:
+            print "SLOWER %s: %.2f us -> %.2f us (%+.1f%%)" % (name, before, result, change * 100)
+        sys.exit(1 if slower else 0)
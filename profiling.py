@@ -0,0 +1,119 @@
+import os
+import time
+import random
+import signal
+import logging
+import cProfile
+import pstats
+import threading
+import collections
+from contextlib import contextmanager
+
+
+# fraction of requests profiled, 0 disables profiling
+SAMPLE_RATE = 0.0
+# where dumps triggered by the signal or the endpoint are written
+DIRECTORY = "."
+DUMP_SIGNAL = signal.SIGUSR2
+# request ids of the sampled requests kept for a dump
+MAX_REQUEST_IDS = 1000
+# functions listed in the text report
+REPORT_LIMIT = 50
+
+
+class Aggregate(object):
+    """cProfile stats of the sampled requests merged into one pstats.Stats.
+
+    A dump writes the stats and starts over, so every dump covers the
+    requests since the previous one.
+    """
+
+    def __init__(self, max_request_ids=MAX_REQUEST_IDS):
+        self.lock = threading.Lock()
+        self.stats = None
+        self.requests = 0
+        self.request_ids = collections.deque(maxlen=max_request_ids)
+
+    def add(self, profile, request_id):
+        with self.lock:
+            if self.stats is None:
+                self.stats = pstats.Stats(profile)
+            else:
+                self.stats.add(profile)
+            self.requests += 1
+            self.request_ids.append(request_id)
+
+    def dump(self, path):
+        """Writes the pstats file to `path` and a text report tagged with the
+        request ids to `path`.txt, returns the number of requests dumped."""
+        with self.lock:
+            stats, requests, request_ids = self.stats, self.requests, list(self.request_ids)
+            self.stats, self.requests = None, 0
+            self.request_ids.clear()
+        if stats is None:
+            return 0
+        stats.dump_stats(path)
+        with open(path + ".txt", "w") as f:
+            f.write("pid: %s\nrequests: %s\nrequest_ids: %s\n\n" % (os.getpid(), requests, " ".join(request_ids)))
+            stats.stream = f
+            stats.sort_stats("cumulative").print_stats(REPORT_LIMIT)
+        return requests
+
+
+_aggregate = Aggregate()
+
+
+def enabled():
+    return SAMPLE_RATE > 0
+
+
+def should_profile():
+    return SAMPLE_RATE >= 1 or (SAMPLE_RATE > 0 and random.random() < SAMPLE_RATE)
+
+
+@contextmanager
+def profiled(request_id):
+    """Profiles the block for a sample of the requests, yields whether this one is sampled."""
+    if not should_profile():
+        yield False
+        return
+    profile = cProfile.Profile()
+    profile.enable()
+    try:
+        yield True
+    finally:
+        profile.disable()
+        _aggregate.add(profile, request_id)
+
+
+def dump(path=None):
+    """Dumps the aggregated profile of this process, returns (path, requests)."""
+    if path is None:
+        path = os.path.join(DIRECTORY, "profile-%s-%s.prof" % (os.getpid(), time.strftime("%Y%m%d%H%M%S")))
+    requests = _aggregate.dump(path)
+    if requests:
+        logging.info("Dumped the profile of %s requests to %s" % (requests, path))
+    return (path if requests else None), requests
+
+
+def _dump_on_signal(signum, frame):
+    # the handler may interrupt a thread holding the aggregate lock
+    thread = threading.Thread(target=dump)
+    thread.daemon = True
+    thread.start()
+
+
+def add_profiling_options(op):
+    op.add_option("--profile-sample", action="store", type=float, default=SAMPLE_RATE,
+                  help="fraction of requests profiled with cProfile, 0 disables profiling")
+    op.add_option("--profile-dir", action="store", default=DIRECTORY,
+                  help="directory of the profiles dumped on SIGUSR2 or POST /profile/")
+
+
+def profiling_from_options(opts):
+    global SAMPLE_RATE, DIRECTORY
+    SAMPLE_RATE = opts.profile_sample
+    DIRECTORY = opts.profile_dir
+    if enabled():
+        signal.signal(DUMP_SIGNAL, _dump_on_signal)
+    return enabled()
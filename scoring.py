@@ -1,22 +1,64 @@
+import math
+import time
+import random
 import hashlib
-import json
+import operator
+import logging
+import threading
 
+from cache import SingleFlight
+from serializers import decode_interests
 
-def get_score(store, phone, email, birthday=None, gender=None, first_name=None, last_name=None):
-    key_parts = [
-        first_name or "",
-        last_name or "",
-        birthday.strftime("%Y%m%d") if birthday is not None else "",
-    ]
-    key = "uid:" + hashlib.md5("".join(key_parts)).hexdigest()
-    # try get from cache,
-    # fallback to heavy calculation in case of cache miss
-    score = store.cache_get(key) or 0
-    if score:
-        try:
-            return float(score)
-        except TypeError:
-            return score
+try:
+    import numpy
+except ImportError:
+    # only needed for the vectorized scorer
+    numpy = None
+
+
+# seconds a computed score stays in the cache
+SCORE_TTL = 60 * 60
+# seconds a process holds the redis lock of a missed key while computing it,
+# 0 coalesces concurrent misses within the process only
+SCORE_LOCK_TTL = 0
+# seconds between cache reads while another process holds the lock
+SCORE_LOCK_POLL = 0.01
+# seconds a score is kept and served past SCORE_TTL while it is refreshed
+# in the background, 0 recomputes expired scores on the request path
+SCORE_STALE_TTL = 0
+# XFetch: fresh scores are refreshed early with a probability growing as
+# their expiry gets closer, scaled by how long a recomputation takes; 0 disables
+SCORE_XFETCH_BETA = 0
+# threads refreshing scores in the background at once, more refreshes are skipped
+MAX_BACKGROUND_REFRESHES = 16
+
+# calc_score arguments in order, the columns of score_columns
+SCORE_FIELDS = ("phone", "email", "birthday", "gender", "first_name", "last_name")
+
+# concurrent misses of a key in this process share one computation
+_score_flights = SingleFlight()
+# keys being refreshed in the background, and the threads refreshing them
+_refreshing = set()
+_refresh_threads = 0
+_refreshing_lock = threading.Lock()
+# moving average of a recomputation and its cache write, seconds
+_compute_time = 0.01
+
+
+_score_fields = operator.itemgetter(*SCORE_FIELDS)
+
+
+def get_score_key(first_name=None, last_name=None, birthday=None):
+    material = (first_name or "") + (last_name or "")
+    if birthday is not None:
+        material += "%04d%02d%02d" % (birthday.year, birthday.month, birthday.day)
+    if isinstance(material, unicode):
+        material = material.encode("utf-8")
+    return "uid:" + hashlib.md5(material).hexdigest()
+
+
+def calc_score(phone, email, birthday=None, gender=None, first_name=None, last_name=None):
+    score = 0
     if phone:
         score += 1.5
     if email:
@@ -25,14 +67,234 @@ def get_score(store, phone, email, birthday=None, gender=None, first_name=None,
         score += 1.5
     if first_name and last_name:
         score += 0.5
-    # cache for 60 minutes
-    store.cache_set(key, score,  60 * 60)
     return score
 
 
+def score_columns(items):
+    """Turns get_score keyword argument dicts into the flag columns of calc_scores."""
+    if numpy is not None:
+        try:
+            rows = map(_score_fields, items)
+        except KeyError:
+            rows = [[item.get(field) for field in SCORE_FIELDS] for item in items]
+        # one truth test per value in C instead of a bool() call each
+        flags = numpy.array(rows, dtype=object).reshape(len(items), len(SCORE_FIELDS)).astype(numpy.bool_)
+        return flags[:, 0], flags[:, 1], flags[:, 2] & flags[:, 3], flags[:, 4] & flags[:, 5]
+    has_phone, has_email, has_birthday_gender, has_name = [], [], [], []
+    for item in items:
+        has_phone.append(bool(item.get("phone")))
+        has_email.append(bool(item.get("email")))
+        has_birthday_gender.append(bool(item.get("birthday") and item.get("gender")))
+        has_name.append(bool(item.get("first_name") and item.get("last_name")))
+    return has_phone, has_email, has_birthday_gender, has_name
+
+
+def calc_scores(has_phone, has_email, has_birthday_gender, has_name):
+    """Vectorized calc_score over columns of per-row flags, returns a float64 array.
+
+    The weights are exact binary fractions and are added in calc_score's
+    order, so every row is bit-identical to calc_score.
+    """
+    if numpy is None:
+        raise RuntimeError("numpy is required for vectorized scoring")
+    scores = numpy.zeros(len(has_phone), dtype=numpy.float64)
+    for flags, weight in ((has_phone, 1.5), (has_email, 1.5), (has_birthday_gender, 1.5), (has_name, 0.5)):
+        scores += numpy.asarray(flags, dtype=numpy.bool_) * weight
+    return scores
+
+
+def _cached_score(score):
+    try:
+        return float(score)
+    except TypeError:
+        return score
+
+
+def _wait_for_score(store, key, timeout):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        time.sleep(SCORE_LOCK_POLL)
+        score = store.cache_get(key)
+        if score:
+            return score
+    return None
+
+
+def _compute_score(store, key, phone, email, birthday, gender, first_name, last_name):
+    global _compute_time
+    token = lock_key = None
+    if SCORE_LOCK_TTL > 0:
+        lock_key = "lock:" + key
+        token = store.lock(lock_key, SCORE_LOCK_TTL)
+        if token is None:
+            # another process is computing it
+            score = _wait_for_score(store, key, SCORE_LOCK_TTL)
+            if score:
+                return _cached_score(score)
+    started = time.time()
+    try:
+        score = calc_score(phone, email, birthday, gender, first_name, last_name)
+        # cache for 60 minutes, kept longer to be served stale
+        store.cache_set(key, score, SCORE_TTL + SCORE_STALE_TTL)
+    finally:
+        if token is not None:
+            store.unlock(lock_key, token)
+    _compute_time += (time.time() - started - _compute_time) * 0.1
+    return score
+
+
+def _refresh(store, key, *args):
+    try:
+        _score_flights.do(key, _compute_score, store, key, *args)
+    except Exception:
+        logging.exception("Refreshing score %s failed" % key)
+    finally:
+        _refreshed([key])
+
+
+def _refresh_many(store, due):
+    try:
+        store.cache_set_many(dict((key, calc_score(**item)) for key, item in due.iteritems()), SCORE_TTL + SCORE_STALE_TTL)
+    except Exception:
+        logging.exception("Refreshing %s scores failed" % len(due))
+    finally:
+        _refreshed(due)
+
+
+def _refreshed(keys):
+    global _refresh_threads
+    with _refreshing_lock:
+        _refreshing.difference_update(keys)
+        _refresh_threads -= 1
+
+
+def _claim_refresh(keys):
+    """Marks the keys nobody refreshes as refreshing and returns them, unless too many threads run."""
+    global _refresh_threads
+    with _refreshing_lock:
+        keys = [key for key in keys if key not in _refreshing]
+        if not keys or _refresh_threads >= MAX_BACKGROUND_REFRESHES:
+            return []
+        _refreshing.update(keys)
+        _refresh_threads += 1
+    return keys
+
+
+def _in_background(target, *args):
+    thread = threading.Thread(target=target, args=args)
+    thread.daemon = True
+    thread.start()
+
+
+def _refresh_in_background(store, key, *args):
+    if not _claim_refresh([key]):
+        return False
+    _in_background(_refresh, store, key, *args)
+    return True
+
+
+def _refresh_many_in_background(store, due):
+    """Refreshes a batch's {key: get_score arguments} in one thread, with one cache write."""
+    keys = _claim_refresh(due)
+    if not keys:
+        return False
+    _in_background(_refresh_many, store, dict((key, due[key]) for key in keys))
+    return True
+
+
+def _needs_refresh(ttl):
+    """Whether a cached score with `ttl` seconds left in the store is stale or due an early refresh."""
+    if ttl is None:
+        return False
+    fresh_for = ttl - SCORE_STALE_TTL
+    if fresh_for <= 0:
+        return True
+    # XFetch, 1 - random() is never 0
+    return _compute_time * SCORE_XFETCH_BETA * -math.log(1.0 - random.random()) >= fresh_for
+
+
+def get_score(store, phone, email, birthday=None, gender=None, first_name=None, last_name=None, key=None):
+    """`key` is the score cache key when the caller has derived it already."""
+    if key is None:
+        key = get_score_key(first_name, last_name, birthday)
+    # try get from cache,
+    # fallback to heavy calculation in case of cache miss
+    if SCORE_STALE_TTL > 0 or SCORE_XFETCH_BETA > 0:
+        score, ttl = store.cache_get_with_ttl(key)
+        if score and _needs_refresh(ttl):
+            _refresh_in_background(store, key, phone, email, birthday, gender, first_name, last_name)
+    else:
+        score = store.cache_get(key)
+    if score:
+        return _cached_score(score)
+    return _score_flights.do(key, _compute_score, store, key, phone, email, birthday, gender, first_name, last_name)
+
+
+def get_scores_many(store, items, keys=None):
+    """Scores a list of get_score keyword argument dicts, `keys` are their cache keys if known.
+
+    All cache keys are read in one round-trip and the misses written back in another.
+    Stale scores, and those XFetch picks, are refreshed together in one background thread.
+    """
+    if keys is None:
+        keys = [get_score_key(item.get("first_name"), item.get("last_name"), item.get("birthday"))
+                for item in items]
+    if SCORE_STALE_TTL > 0 or SCORE_XFETCH_BETA > 0:
+        values, due = [], {}
+        for key, item, (value, ttl) in zip(keys, items, store.cache_get_many_with_ttl(keys)):
+            values.append(value)
+            if value and _needs_refresh(ttl):
+                due[key] = item
+        if due:
+            _refresh_many_in_background(store, due)
+    else:
+        values = list(store.cache_get_many(keys))
+    scores, missed = [], {}
+    for key, cached, item in zip(keys, values, items):
+        if cached:
+            scores.append(_cached_score(cached))
+        else:
+            missed.setdefault(key, item)
+            scores.append(None)
+    # calc_scores is slower on dict rows than calc_score row by row
+    misses = dict((key, calc_score(**item)) for key, item in missed.iteritems())
+    for position, key in enumerate(keys):
+        if scores[position] is None:
+            scores[position] = misses[key]
+    if misses:
+        store.cache_set_many(misses, SCORE_TTL + SCORE_STALE_TTL)
+    return scores
+
+
+def add_scoring_options(op):
+    op.add_option("--score-lock-ttl", action="store", type=float, default=SCORE_LOCK_TTL,
+                  help="seconds a missed score key is locked in redis while one process computes it, "
+                       "0 coalesces misses within each process only")
+    op.add_option("--score-stale-ttl", action="store", type=float, default=SCORE_STALE_TTL,
+                  help="seconds an expired score is still served while it is refreshed in the background")
+    op.add_option("--score-xfetch-beta", action="store", type=float, default=SCORE_XFETCH_BETA,
+                  help="eagerness of the probabilistic early refresh of scores close to expiry, 0 disables it")
+
+
+def scoring_from_options(opts):
+    global SCORE_LOCK_TTL, SCORE_STALE_TTL, SCORE_XFETCH_BETA
+    SCORE_LOCK_TTL = opts.score_lock_ttl
+    SCORE_STALE_TTL = opts.score_stale_ttl
+    SCORE_XFETCH_BETA = opts.score_xfetch_beta
+
+
 def get_interests(store, cid):
-    r = store.get("i:%s" % cid)
-    return json.loads(r) if r else []
+    if hasattr(store, "interests_many"):
+        return store.interests_many([cid])[0]
+    return decode_interests(store.get("i:%s" % cid))
+
+
+def get_interests_many(store, cids):
+    # stores holding decoded interests, like the snapshot, skip the keys
+    if hasattr(store, "interests_many"):
+        return store.interests_many(cids)
+    values = store.get_many(["i:%s" % cid for cid in cids])
+    return [decode_interests(r) for r in values]
 
 # import random
 #
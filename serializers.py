@@ -0,0 +1,77 @@
+"""Encodings on the request path: the JSON backend and the stored interests format.
+
+ujson is used for request and response bodies when it is installed, the
+stdlib json module otherwise. Interests values written before formats were
+versioned are plain JSON; the other formats start with MARKER and a version
+byte, which never starts a JSON document, so readers decode every format
+and stores can be migrated value by value.
+"""
+
+import json
+
+try:
+    import ujson
+except ImportError:
+    ujson = None
+
+try:
+    import msgpack
+except ImportError:
+    # only needed for the msgpack interests format
+    msgpack = None
+
+
+MARKER = "\x00"
+MSGPACK_V1 = "\x01"
+INTERESTS_FORMATS = ("json", "msgpack")
+
+
+def _ujson_dumps(value):
+    return ujson.dumps(value, escape_forward_slashes=False)
+
+
+JSON_BACKENDS = {"json": (json.loads, json.dumps)}
+if ujson is not None:
+    JSON_BACKENDS["ujson"] = (ujson.loads, _ujson_dumps)
+
+JSON_BACKEND = None
+loads = dumps = None
+
+
+def use_json(name):
+    """Switches loads and dumps to one of JSON_BACKENDS."""
+    global JSON_BACKEND, loads, dumps
+    if name not in JSON_BACKENDS:
+        raise ValueError("JSON backend %r is not available, expected one of %s"
+                         % (name, ", ".join(sorted(JSON_BACKENDS))))
+    JSON_BACKEND = name
+    loads, dumps = JSON_BACKENDS[name]
+
+
+use_json("ujson" if ujson is not None else "json")
+
+
+def _require_msgpack():
+    if msgpack is None:
+        raise RuntimeError("msgpack is required for the msgpack interests format")
+
+
+def encode_interests(interests, format="json"):
+    if format == "json":
+        return dumps(interests)
+    if format == "msgpack":
+        _require_msgpack()
+        return MARKER + MSGPACK_V1 + msgpack.packb(interests, use_bin_type=False)
+    raise ValueError("Unknown interests format %r, expected one of %s" % (format, ", ".join(INTERESTS_FORMATS)))
+
+
+def decode_interests(raw):
+    if not raw:
+        return []
+    if raw[0] != MARKER:
+        return loads(raw)
+    version = raw[1:2]
+    if version == MSGPACK_V1:
+        _require_msgpack()
+        return msgpack.unpackb(raw[2:], raw=False)
+    raise ValueError("Unknown interests format version %r" % version)
@@ -0,0 +1,272 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Read-only, memory-mapped snapshot of the client interests.
+
+    python snapshot.py -o interests.snapshot --redis-host redis.local
+
+exports every i:<cid> key of the store. `--interests-snapshot interests.snapshot`
+then serves client_interests from the file, which every worker process
+maps and shares through the page cache.
+
+Layout, little-endian, every section aligned to its item size:
+
+    header      magic, version, clients, members, strings, blob size (HEADER_SIZE bytes)
+    cids        int64 per client, sorted
+    spans       (first member, member count) uint32 pairs per client
+    members     uint32 string id per interest of every client
+    offsets     uint32 per string and one past the last, into the blob
+    blob        the interned interests, UTF-8
+"""
+
+import os
+import sys
+import mmap
+import time
+import array
+import struct
+import logging
+from optparse import OptionParser
+
+from serializers import decode_interests
+
+try:
+    import numpy
+except ImportError:
+    # only needed for the vectorized lookups
+    numpy = None
+
+
+MAGIC = "SCIS"
+VERSION = 1
+HEADER = struct.Struct("<4sB3xIIII")
+HEADER_SIZE = 32
+CID = struct.Struct("<q")
+MIN_CID, MAX_CID = -2 ** 63, 2 ** 63 - 1
+SPAN = struct.Struct("<II")
+# seconds between checks for a replaced snapshot file
+CHECK_INTERVAL = 60
+
+
+def client_id(cid):
+    """The int64 id of the i:<cid> key, None if no snapshot holds that key.
+
+    Like the key, "1" is client 1, while 1.0, "01" or True are no client.
+    """
+    if type(cid) is int:
+        return cid
+    text = "%s" % (cid,)
+    try:
+        cid = int(text)
+    except ValueError:
+        return None
+    if "%s" % cid != text:
+        return None
+    return cid if MIN_CID <= cid <= MAX_CID else None
+
+
+def _little_endian(values):
+    if sys.byteorder != "little":
+        values.byteswap()
+    return values.tostring()
+
+
+def write_snapshot(path, interests):
+    """Writes (cid, list of interests) pairs to `path`, returns the number of clients.
+
+    The file is written next to `path` and renamed over it, so processes
+    mapping the previous snapshot keep reading a complete one. The
+    snapshot only holds lists of strings, any other interests raise a
+    ValueError instead of being served differently from the store.
+    """
+    strings, string_ids, entries = [], {}, []
+    for cid, values in interests:
+        client = client_id(cid)
+        if client is None:
+            raise ValueError("%r is not a client id" % (cid,))
+        if not isinstance(values, (list, tuple)) or not all(isinstance(value, basestring) for value in values):
+            raise ValueError("Interests of client %s are not a list of strings: %r" % (client, values))
+        ids = []
+        for value in values:
+            if isinstance(value, str):
+                value = value.decode("utf-8")
+            string_id = string_ids.get(value)
+            if string_id is None:
+                string_id = string_ids[value] = len(strings)
+                strings.append(value)
+            ids.append(string_id)
+        entries.append((client, ids))
+    entries.sort(key=lambda entry: entry[0])
+    cids, spans, members = [], array.array("I"), array.array("I")
+    for cid, ids in entries:
+        if cids and cid == cids[-1]:
+            raise ValueError("Client %s is exported twice" % cid)
+        cids.append(cid)
+        spans.extend((len(members), len(ids)))
+        members.extend(ids)
+    encoded = [value.encode("utf-8") for value in strings]
+    offsets, position = array.array("I", [0]), 0
+    for value in encoded:
+        position += len(value)
+        offsets.append(position)
+    blob = "".join(encoded)
+    tmp_path = "%s.%s.tmp" % (path, os.getpid())
+    with open(tmp_path, "wb") as f:
+        f.write(HEADER.pack(MAGIC, VERSION, len(cids), len(members), len(strings), len(blob)).ljust(HEADER_SIZE, "\0"))
+        # array has no int64 typecode on python 2
+        f.write(struct.pack("<%dq" % len(cids), *cids))
+        for section in (spans, members, offsets):
+            f.write(_little_endian(section))
+        f.write(blob)
+    os.rename(tmp_path, path)
+    return len(cids)
+
+
+class InterestsSnapshot(object):
+    """Lookups in a snapshot file, straight from its read-only mapping."""
+
+    def __init__(self, path):
+        self.path = path
+        with open(path, "rb") as f:
+            self.inode = os.fstat(f.fileno()).st_ino
+            self.map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        if len(self.map) < HEADER_SIZE:
+            raise ValueError("%s is not an interests snapshot" % path)
+        magic, version, self.clients, members, strings, blob_size = HEADER.unpack_from(self.map, 0)
+        if magic != MAGIC or version != VERSION:
+            raise ValueError("%s is not a version %s interests snapshot" % (path, VERSION))
+        self.cids_at = HEADER_SIZE
+        self.spans_at = self.cids_at + CID.size * self.clients
+        self.members_at = self.spans_at + SPAN.size * self.clients
+        offsets_at = self.members_at + 4 * members
+        blob_at = offsets_at + 4 * (strings + 1)
+        if len(self.map) != blob_at + blob_size:
+            raise ValueError("%s is truncated" % path)
+        # the interned table is small, decoded once per process
+        offsets = struct.unpack_from("<%dI" % (strings + 1), self.map, offsets_at)
+        self.strings = [self.map[blob_at + start:blob_at + end].decode("utf-8")
+                        for start, end in zip(offsets, offsets[1:])]
+        self.cids = None
+        if numpy is not None:
+            self.cids = numpy.frombuffer(self.map, dtype="<i8", count=self.clients, offset=self.cids_at)
+
+    def close(self):
+        self.cids = None
+        self.map.close()
+
+    def __len__(self):
+        return self.clients
+
+    def _position(self, cid):
+        lo, hi = 0, self.clients
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if CID.unpack_from(self.map, self.cids_at + CID.size * mid)[0] < cid:
+                lo = mid + 1
+            else:
+                hi = mid
+        if lo < self.clients and CID.unpack_from(self.map, self.cids_at + CID.size * lo)[0] == cid:
+            return lo
+        return None
+
+    def _interests(self, position):
+        if position is None:
+            return []
+        start, count = SPAN.unpack_from(self.map, self.spans_at + SPAN.size * position)
+        strings = self.strings
+        return [strings[string_id] for string_id in
+                struct.unpack_from("<%dI" % count, self.map, self.members_at + 4 * start)]
+
+    def get(self, cid):
+        cid = client_id(cid)
+        return [] if cid is None else self._interests(self._position(cid))
+
+    def get_many(self, cids):
+        if self.cids is None or not cids:
+            return [self.get(cid) for cid in cids]
+        # ints always fit int64, they need no normalizing
+        if all(type(cid) is int for cid in cids):
+            return self._search(cids)
+        ids = [client_id(cid) for cid in cids]
+        found = iter(self._search([cid for cid in ids if cid is not None]))
+        return [[] if cid is None else next(found) for cid in ids]
+
+    def _search(self, cids):
+        if not cids:
+            return []
+        wanted = numpy.array(cids, dtype=numpy.int64)
+        positions = numpy.minimum(numpy.searchsorted(self.cids, wanted), max(self.clients - 1, 0))
+        found = (self.cids[positions] == wanted) if self.clients else numpy.zeros(len(cids), dtype=numpy.bool_)
+        return [self._interests(position if hit else None)
+                for position, hit in zip(positions.tolist(), found.tolist())]
+
+
+class SnapshotStore(object):
+    """Serves the interests from a snapshot, everything else from the wrapped store.
+
+    A snapshot file replaced by a new export is picked up within
+    `check_interval` seconds.
+    """
+
+    def __init__(self, path, store, check_interval=CHECK_INTERVAL):
+        self.path = path
+        self.store = store
+        self.check_interval = check_interval
+        self.snapshot = InterestsSnapshot(path)
+        self.checked = time.time()
+
+    def __getattr__(self, name):
+        return getattr(self.store, name)
+
+    def reload_if_replaced(self, now):
+        self.checked = now
+        try:
+            inode = os.stat(self.path).st_ino
+        except OSError:
+            return
+        if inode != self.snapshot.inode:
+            # the previous mapping is left to the requests still using it
+            self.snapshot = InterestsSnapshot(self.path)
+            logging.info("Loaded the interests snapshot %s of %s clients" % (self.path, len(self.snapshot)))
+
+    def interests_many(self, cids):
+        """Decoded interests of the cids, stores without this method are read key by key."""
+        now = time.time()
+        if now - self.checked >= self.check_interval:
+            self.reload_if_replaced(now)
+        return self.snapshot.get_many(cids)
+
+
+def read_interests(store, batch_size=1000):
+    """Yields (cid, interests) of every i:<cid> key of the store."""
+    keys = []
+    for key in store.scan("i:*"):
+        keys.append(key)
+        if len(keys) >= batch_size:
+            for pair in _read_batch(store, keys):
+                yield pair
+            keys = []
+    for pair in _read_batch(store, keys):
+        yield pair
+
+
+def _read_batch(store, keys):
+    for key, value in zip(keys, store.get_many(keys)):
+        cid = client_id(key[2:])
+        if cid is not None and value is not None:
+            yield cid, decode_interests(value)
+
+
+if __name__ == "__main__":
+    from store import add_store_options, store_from_options
+    op = OptionParser()
+    op.add_option("-o", "--output", action="store", help="snapshot file, replaced atomically")
+    op.add_option("-b", "--batch-size", action="store", type=int, default=1000, help="keys per round-trip")
+    add_store_options(op)
+    (opts, args) = op.parse_args()
+    if not opts.output:
+        op.error("--output is required")
+    logging.basicConfig(level=logging.INFO, format='[%(asctime)s] %(levelname).1s %(message)s',
+                        datefmt='%Y.%m.%d %H:%M:%S')
+    started = time.time()
+    clients = write_snapshot(opts.output, read_interests(store_from_options(opts), opts.batch_size))
+    logging.info("Exported %s clients to %s in %.1fs" % (clients, opts.output, time.time() - started))
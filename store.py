@@ -1,33 +1,397 @@
+import os
+import abc
+import mmap
+import zlib
+import fcntl
+import fnmatch
 import redis
 import time
+import uuid
+import struct
+import random
 import functools
+import threading
+from Queue import Empty
+from contextlib import contextmanager
 
+import metrics
+from cache import LRUCache
+from snapshot import SnapshotStore
 
-def connection_time_out(func):
-    @functools.wraps(func)
-    def wrapper(*args, **kwargs):
-        for _ in range(5):
+
+# defaults for the Store connection settings, overridable from the environment
+DEFAULT_HOST = os.environ.get("REDIS_HOST", "localhost")
+DEFAULT_PORT = int(os.environ.get("REDIS_PORT", 6379))
+DEFAULT_DB = int(os.environ.get("REDIS_DB", 0))
+DEFAULT_SOCKET_TIMEOUT = float(os.environ.get("REDIS_SOCKET_TIMEOUT", 1))
+DEFAULT_CONNECT_TIMEOUT = float(os.environ.get("REDIS_CONNECT_TIMEOUT", 1))
+DEFAULT_MAX_CONNECTIONS = int(os.environ.get("REDIS_MAX_CONNECTIONS", 50))
+# seconds a request waits for a free connection before failing
+DEFAULT_POOL_TIMEOUT = float(os.environ.get("REDIS_POOL_TIMEOUT", 5))
+# entries of the memory and mmap stores
+DEFAULT_STORE_ENTRIES = 1000000
+DEFAULT_STORE_PATH = "store.mmap"
+# bytes of an mmap store slot, which holds a key, its value and 13 bytes of header
+DEFAULT_SLOT_SIZE = 256
+STORES = ("redis", "memory", "mmap")
+
+
+# errors worth retrying, anything else is raised right away; a full
+# pool is not retried, it never reached redis
+RETRY_ERRORS = (redis.ConnectionError, redis.TimeoutError)
+# deletes a lock only while it holds the caller's token
+UNLOCK_SCRIPT = """
+if redis.call("get", KEYS[1]) == ARGV[1] then
+    return redis.call("del", KEYS[1])
+end
+return 0
+"""
+
+
+class CircuitOpenError(redis.ConnectionError):
+    pass
+
+
+class PoolExhaustedError(redis.ConnectionError):
+    """No pooled connection was freed in time, redis was not contacted."""
+
+
+class RetryPolicy(object):
+    """Retries with jittered exponential backoff within a total deadline, seconds."""
+
+    def __init__(self, attempts=3, base_delay=0.05, max_delay=0.5, deadline=1.0):
+        self.attempts = attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.deadline = deadline
+
+    def backoff(self, attempt):
+        # "full jitter": spreads the retries of concurrent requests apart
+        return random.uniform(0, min(self.max_delay, self.base_delay * 2 ** (attempt - 1)))
+
+
+class CircuitBreaker(object):
+    """Fails fast once `failure_threshold` calls in a row failed.
+
+    After `reset_timeout` seconds a single trial call is let through,
+    its success closes the circuit again.
+    """
+
+    def __init__(self, failure_threshold=5, reset_timeout=5.0):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at = None
+        self.lock = threading.Lock()
+
+    @property
+    def is_open(self):
+        return self.opened_at is not None
+
+    def allow(self):
+        with self.lock:
+            if self.opened_at is None:
+                return True
+            if time.time() - self.opened_at >= self.reset_timeout:
+                # half-open: the next trial is allowed only after another timeout
+                self.opened_at = time.time()
+                return True
+            return False
+
+    def record_success(self):
+        with self.lock:
+            self.failures = 0
+            self.opened_at = None
+
+    def record_failure(self):
+        with self.lock:
+            self.failures += 1
+            if self.failures >= self.failure_threshold:
+                self.opened_at = time.time()
+
+
+DEFAULT_RETRY_POLICIES = {
+    # interests have no fallback, worth a few quick retries
+    "get": RetryPolicy(attempts=3, base_delay=0.05, max_delay=0.5, deadline=1.0),
+    # a cache miss is cheaper than waiting for redis
+    "cache": RetryPolicy(attempts=2, base_delay=0.01, max_delay=0.05, deadline=0.1),
+}
+
+
+def retry(operation):
+    """Runs a Store method under the store's retry policy for `operation`.
+
+    The whole call, retries included, is timed as the "store_<method>" stage.
+    """
+    def decorator(func):
+        stage = "store_" + func.__name__
+
+        @functools.wraps(func)
+        def wrapper(self, *args, **kwargs):
+            with metrics.timed(stage):
+                return self.retrying(operation, func, self, *args, **kwargs)
+        return wrapper
+    return decorator
+
+
+class CountingConnectionPool(redis.BlockingConnectionPool):
+    """Bounded, thread-safe connection pool which keeps utilization counters.
+
+    Callers block for up to `timeout` seconds once `max_connections`
+    connections are checked out, instead of opening new ones, and get a
+    PoolExhaustedError after that. Within `deadline` the wait and the
+    replies are also cut at the time left; connecting a new connection
+    still takes up to its socket_connect_timeout.
+    """
+
+    def reset(self):
+        # also called after a fork, so the counters are per process
+        super(CountingConnectionPool, self).reset()
+        self._stats_lock = threading.Lock()
+        self._checked_out = set()
+        self._deadlines = threading.local()
+        self.in_use = 0
+        self.peak_in_use = 0
+        self.checkouts = 0
+        self.wait_time = 0.0
+
+    @contextmanager
+    def deadline(self, deadline):
+        """Cuts the waits of this thread's commands at the `deadline` timestamp."""
+        self._deadlines.at = deadline
+        try:
+            yield
+        finally:
+            self._deadlines.at = None
+
+    def _time_left(self, timeout, now):
+        deadline = getattr(self._deadlines, "at", None)
+        if deadline is None:
+            return timeout
+        # a millisecond at least, a zero timeout makes sockets non-blocking
+        left = max(deadline - now, 0.001)
+        return left if timeout is None else min(timeout, left)
+
+    def get_connection(self, command_name, *keys, **options):
+        # the base pool's, with the wait cut at the deadline
+        self._checkpid()
+        started = time.time()
+        try:
+            connection = self.pool.get(block=True, timeout=self._time_left(self.timeout, started))
+        except Empty:
+            raise PoolExhaustedError("No connection available.")
+        if connection is None:
+            connection = self.make_connection()
+        try:
+            connection.connect()
             try:
-                return func(*args, **kwargs)
+                if connection.can_read():
+                    raise redis.ConnectionError("Connection has data")
             except redis.ConnectionError:
-                time.sleep(5)
-            raise redis.ConnectionError
-    return wrapper
+                connection.disconnect()
+                connection.connect()
+                if connection.can_read():
+                    raise redis.ConnectionError("Connection not ready")
+        except BaseException:
+            self.release(connection)
+            raise
+        sock = getattr(connection, "_sock", None)
+        if sock is not None:
+            sock.settimeout(self._time_left(connection.socket_timeout, time.time()))
+        with self._stats_lock:
+            self._checked_out.add(connection)
+            self.in_use += 1
+            self.peak_in_use = max(self.peak_in_use, self.in_use)
+            self.checkouts += 1
+            self.wait_time += time.time() - started
+        return connection
+
+    def release(self, connection):
+        sock = getattr(connection, "_sock", None)
+        if sock is not None:
+            sock.settimeout(connection.socket_timeout)
+        super(CountingConnectionPool, self).release(connection)
+        # the base pool also releases connections which failed to connect
+        # before they were handed out, those were never counted
+        with self._stats_lock:
+            if connection in self._checked_out:
+                self._checked_out.discard(connection)
+                self.in_use -= 1
+
+    def stats(self):
+        with self._stats_lock:
+            return {
+                "max_connections": self.max_connections,
+                "created": len(self._connections),
+                "in_use": self.in_use,
+                "peak_in_use": self.peak_in_use,
+                "checkouts": self.checkouts,
+                "wait_time": self.wait_time,
+            }
+
+
+def encode_key(key):
+    return key.encode("utf-8") if isinstance(key, unicode) else key
 
 
-class Store(object):
-    def __init__(self):
-        self.conn = redis.StrictRedis(host='localhost', port=6379, db=0)
+def encode_value(val):
+    """Values are stored as redis stores them: strings, with numbers in their repr."""
+    if isinstance(val, str):
+        return val
+    if isinstance(val, unicode):
+        return val.encode("utf-8")
+    if isinstance(val, float):
+        return repr(val)
+    if isinstance(val, (int, long)) and not isinstance(val, bool):
+        return str(val)
+    raise TypeError("Values must be strings or numbers, got %s" % type(val).__name__)
 
-    @connection_time_out
+
+class BaseStore(object):
+    """Interface of the stores behind the api.
+
+    `get` reads the interests, which have no fallback, `cache_*` the score
+    cache, which is allowed to miss. Backends implement the abstract methods,
+    the others have generic versions built on them which a backend overrides
+    when it can batch them.
+    """
+    __metaclass__ = abc.ABCMeta
+
+    @abc.abstractmethod
+    def get(self, key):
+        pass
+
+    @abc.abstractmethod
+    def set(self, key, val):
+        """Stores a value which never expires."""
+
+    @abc.abstractmethod
+    def cache_get_with_ttl(self, key):
+        """Returns the cached value and its remaining lifetime in seconds, None if it never expires."""
+
+    @abc.abstractmethod
+    def cache_set(self, key, val, duration=60*60):
+        pass
+
+    @abc.abstractmethod
+    def delete(self, key):
+        pass
+
+    def lock(self, key, ttl):
+        """Takes a lock which expires after ttl seconds, returns its token, None if it is held."""
+        raise NotImplementedError("%s has no locks" % type(self).__name__)
+
+    def unlock(self, key, token):
+        raise NotImplementedError("%s has no locks" % type(self).__name__)
+
+    def scan(self, match):
+        """Iterates over the keys matching a glob pattern, for exports."""
+        raise NotImplementedError("%s can not be scanned" % type(self).__name__)
+
+    def get_many(self, keys):
+        return [self.get(key) for key in keys]
+
+    def cache_get(self, key):
+        return self.cache_get_with_ttl(key)[0]
+
+    def cache_get_many(self, keys):
+        return [self.cache_get(key) for key in keys]
+
+    def cache_get_many_with_ttl(self, keys):
+        return [self.cache_get_with_ttl(key) for key in keys]
+
+    def cache_set_many(self, mapping, duration=60*60):
+        for key, val in mapping.iteritems():
+            self.cache_set(key, val, duration)
+
+
+class RedisStore(BaseStore):
+    def __init__(self, host=DEFAULT_HOST, port=DEFAULT_PORT, db=DEFAULT_DB,
+                 socket_timeout=DEFAULT_SOCKET_TIMEOUT, socket_connect_timeout=DEFAULT_CONNECT_TIMEOUT,
+                 max_connections=DEFAULT_MAX_CONNECTIONS, pool_timeout=DEFAULT_POOL_TIMEOUT,
+                 retry_policies=None, breaker=None):
+        self.policies = dict(DEFAULT_RETRY_POLICIES, **(retry_policies or {}))
+        self.breaker = breaker or CircuitBreaker()
+        self.pool = CountingConnectionPool(host=host, port=port, db=db,
+                                           socket_timeout=socket_timeout,
+                                           socket_connect_timeout=socket_connect_timeout,
+                                           max_connections=max_connections,
+                                           timeout=pool_timeout)
+        self.conn = redis.StrictRedis(connection_pool=self.pool)
+        self._unlock = self.conn.register_script(UNLOCK_SCRIPT)
+
+    def pool_stats(self):
+        return self.pool.stats()
+
+    def retrying(self, operation, func, *args, **kwargs):
+        policy = self.policies[operation]
+        deadline = time.time() + policy.deadline
+        attempt = 0
+        while True:
+            if not self.breaker.allow():
+                raise CircuitOpenError("Redis is unavailable, circuit is open")
+            try:
+                with self.pool.deadline(deadline):
+                    result = func(*args, **kwargs)
+            except PoolExhaustedError:
+                # the load is on our side, redis is no less available
+                raise
+            except RETRY_ERRORS:
+                self.breaker.record_failure()
+                attempt += 1
+                delay = policy.backoff(attempt)
+                if attempt >= policy.attempts or time.time() + delay > deadline:
+                    raise
+                time.sleep(delay)
+            else:
+                self.breaker.record_success()
+                return result
+
+    @retry("get")
     def get(self, key):
         return self.conn.get(key)
 
-    @connection_time_out
+    @retry("get")
+    def set(self, key, val):
+        self.conn.set(key, val)
+
+    @retry("get")
+    def get_many(self, keys):
+        # one MGET round-trip, values come back in the order of keys
+        if not keys:
+            return []
+        return self.conn.mget(keys)
+
+    @retry("cache")
     def cache_get(self, key):
         return self.conn.get(key)
 
-    @connection_time_out
+    def scan(self, match, count=1000):
+        # SCAN does not block redis like KEYS, keys changed meanwhile may be missed
+        return self.conn.scan_iter(match=match, count=count)
+
+    @retry("cache")
+    def cache_get_with_ttl(self, key):
+        """Returns the cached value and its remaining lifetime in seconds, None if it never expires."""
+        value, ttl = self.conn.pipeline(transaction=False).get(key).pttl(key).execute()
+        return value, ttl / 1000.0 if ttl >= 0 else None
+
+    @retry("cache")
+    def cache_get_many(self, keys):
+        if not keys:
+            return []
+        return self.conn.mget(keys)
+
+    @retry("cache")
+    def cache_get_many_with_ttl(self, keys):
+        pipeline = self.conn.pipeline(transaction=False)
+        for key in keys:
+            pipeline.get(key).pttl(key)
+        replies = pipeline.execute()
+        return [(value, ttl / 1000.0 if ttl >= 0 else None)
+                for value, ttl in zip(replies[::2], replies[1::2])]
+
+    @retry("cache")
     def cache_set(self, key, val, duration=60*60):
         if isinstance(val, (str, float)) or val == 0:
             self.conn.setex(key, duration, val)
@@ -37,6 +401,408 @@ class Store(object):
         else:
             raise TypeError
 
-    @connection_time_out
+    @retry("cache")
+    def cache_set_many(self, mapping, duration=60*60):
+        pipeline = self.conn.pipeline(transaction=False)
+        for key, val in mapping.iteritems():
+            if not (isinstance(val, (str, float)) or val == 0):
+                raise TypeError
+            pipeline.setex(key, duration, val)
+        pipeline.execute()
+
+    @retry("get")
     def delete(self, key):
         self.conn.delete(key)
+
+    @retry("cache")
+    def lock(self, key, ttl):
+        """Takes a lock which expires after ttl seconds, returns its token, None if it is held."""
+        token = uuid.uuid4().hex
+        return token if self.conn.set(key, token, px=int(ttl * 1000), nx=True) else None
+
+    @retry("cache")
+    def unlock(self, key, token):
+        """Releases the lock unless it expired and was taken by someone else."""
+        self._unlock(keys=[key], args=[token])
+
+
+# the store was redis only
+Store = RedisStore
+
+
+class MemoryStore(BaseStore):
+    """Thread-safe store in process memory.
+
+    The cache is bounded by entries and bytes like the L1 cache; values
+    stored with `set` are kept apart and never evicted, they may be the
+    only copy of the data. For single node deployments, tests and
+    benchmarks; every process has its own.
+    """
+
+    def __init__(self, max_entries=DEFAULT_STORE_ENTRIES, max_bytes=None):
+        self.data = LRUCache(max_entries=max_entries, max_bytes=max_bytes)
+        self.values = {}
+        self.locks = {}
+        self.locks_lock = threading.Lock()
+
+    def get(self, key):
+        value = self.values.get(key)
+        return self.data.get(key) if value is None else value
+
+    def set(self, key, val):
+        self.values[key] = encode_value(val)
+        self.data.delete(key)
+
+    def cache_get_with_ttl(self, key):
+        value, ttl = self.data.get_with_ttl(key)
+        if value is None:
+            return self.values.get(key), None
+        return value, None if ttl == float("inf") else ttl
+
+    def cache_set(self, key, val, duration=60*60):
+        self.data.set(key, encode_value(val), duration)
+        self.values.pop(key, None)
+
+    def delete(self, key):
+        self.data.delete(key)
+        self.values.pop(key, None)
+
+    def scan(self, match):
+        now = time.time()
+        with self.data.lock:
+            keys = [key for key, (_, expires_at, _) in self.data.entries.iteritems()
+                    if expires_at is None or expires_at > now]
+        return iter(fnmatch.filter(keys + list(self.values), match))
+
+    def lock(self, key, ttl):
+        token = uuid.uuid4().hex
+        now = time.time()
+        with self.locks_lock:
+            held = self.locks.get(key)
+            if held is not None and held[1] > now:
+                return None
+            self.locks[key] = (token, now + ttl)
+        return token
+
+    def unlock(self, key, token):
+        with self.locks_lock:
+            held = self.locks.get(key)
+            if held is not None and held[0] == token:
+                del self.locks[key]
+
+    def stats(self):
+        return dict(self.data.stats(), values=len(self.values))
+
+
+class MmapStore(BaseStore):
+    """Fixed-size hash table in a memory-mapped file, shared by every process which maps it.
+
+    Every slot holds one key and value. Keys are placed by open addressing
+    from their crc32, and a full probe sequence evicts the entry closest to
+    expiry; values stored with `set` never expire and are not evicted.
+    Writers hold an exclusive lockf lock on the file and readers a shared
+    one, so pre-forked workers share the data without a server.
+    """
+
+    MAGIC = "SCMM"
+    VERSION = 1
+    # magic, version, slots, slot size
+    HEADER = struct.Struct("<4sBII")
+    # state, expiry timestamp (0 never expires), key size, value size
+    SLOT = struct.Struct("<BdHH")
+    EMPTY, USED, DELETED = 0, 1, 2
+    MAX_PROBES = 16
+
+    def __init__(self, path=DEFAULT_STORE_PATH, slots=DEFAULT_STORE_ENTRIES, slot_size=DEFAULT_SLOT_SIZE):
+        self.path = path
+        self.thread_lock = threading.Lock()
+        if os.path.exists(path) and os.path.getsize(path) >= self.HEADER.size:
+            self.file = open(path, "r+b")
+            magic, version, slots, slot_size = self.HEADER.unpack(self.file.read(self.HEADER.size))
+            if magic != self.MAGIC or version != self.VERSION:
+                raise ValueError("%s is not a version %s store file" % (path, self.VERSION))
+        else:
+            self.file = open(path, "w+b")
+            self.file.write(self.HEADER.pack(self.MAGIC, self.VERSION, slots, slot_size))
+            self.file.flush()
+            self.file.truncate(self.HEADER.size + slots * slot_size)
+        self.slots = slots
+        self.slot_size = slot_size
+        self.map = mmap.mmap(self.file.fileno(), self.HEADER.size + slots * slot_size)
+
+    def close(self):
+        self.map.close()
+        self.file.close()
+
+    @contextmanager
+    def locked(self, exclusive):
+        # lockf excludes other processes, the thread lock the threads of this one
+        with self.thread_lock:
+            fcntl.lockf(self.file.fileno(), fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH)
+            try:
+                yield
+            finally:
+                fcntl.lockf(self.file.fileno(), fcntl.LOCK_UN)
+
+    def _slot(self, index):
+        offset = self.HEADER.size + index * self.slot_size
+        state, expires_at, key_size, value_size = self.SLOT.unpack_from(self.map, offset)
+        return state, expires_at, offset + self.SLOT.size, key_size, value_size
+
+    def _probes(self, key):
+        start = zlib.crc32(key) & 0xffffffff
+        return [(start + i) % self.slots for i in range(min(self.MAX_PROBES, self.slots))]
+
+    def _find(self, key, now):
+        """Returns the slot of the live key or None, and the first reusable slot or None."""
+        free = None
+        for index in self._probes(key):
+            state, expires_at, start, key_size, _ = self._slot(index)
+            if state == self.EMPTY:
+                return None, index if free is None else free
+            live = state == self.USED and not (expires_at and expires_at <= now)
+            if live and key_size == len(key) and self.map[start:start + key_size] == key:
+                return index, free
+            if not live and free is None:
+                free = index
+        return None, free
+
+    def _victim(self, key):
+        # every probed slot is live, the one expiring first goes; values
+        # which never expire are not evicted
+        expiring = [index for index in self._probes(key) if self._slot(index)[1]]
+        return min(expiring, key=lambda index: self._slot(index)[1]) if expiring else None
+
+    def _read(self, key, now):
+        index, _ = self._find(key, now)
+        if index is None:
+            return None, None
+        _, expires_at, start, key_size, value_size = self._slot(index)
+        value = self.map[start + key_size:start + key_size + value_size]
+        return value, expires_at - now if expires_at else None
+
+    def _write(self, key, val, duration, now):
+        index, free = self._find(key, now)
+        if index is None:
+            index = free if free is not None else self._victim(key)
+        if index is None:
+            if duration is None:
+                raise ValueError("No slot for %r, the values which never expire fill its probes" % key)
+            # the cache may miss
+            return
+        _, _, start, _, _ = self._slot(index)
+        expires_at = 0.0 if duration is None else now + duration
+        self.SLOT.pack_into(self.map, start - self.SLOT.size, self.USED, expires_at, len(key), len(val))
+        self.map[start:start + len(key) + len(val)] = key + val
+
+    def _delete(self, key, now):
+        index, _ = self._find(key, now)
+        if index is not None:
+            _, _, start, _, _ = self._slot(index)
+            struct.pack_into("<B", self.map, start - self.SLOT.size, self.DELETED)
+
+    def _encode(self, key, val):
+        key, val = encode_key(key), encode_value(val)
+        if self.SLOT.size + len(key) + len(val) > self.slot_size:
+            raise ValueError("%s bytes of key and value do not fit a %s byte slot"
+                             % (len(key) + len(val), self.slot_size))
+        return key, val
+
+    def get(self, key):
+        return self.cache_get_with_ttl(key)[0]
+
+    def set(self, key, val):
+        self.cache_set(key, val, None)
+
+    def cache_get_with_ttl(self, key):
+        key = encode_key(key)
+        with self.locked(False):
+            return self._read(key, time.time())
+
+    def cache_get_many_with_ttl(self, keys):
+        keys = [encode_key(key) for key in keys]
+        with self.locked(False):
+            now = time.time()
+            return [self._read(key, now) for key in keys]
+
+    def get_many(self, keys):
+        return [value for value, _ in self.cache_get_many_with_ttl(keys)]
+
+    cache_get_many = get_many
+
+    def scan(self, match):
+        keys = []
+        with self.locked(False):
+            now = time.time()
+            for index in xrange(self.slots):
+                state, expires_at, start, key_size, _ = self._slot(index)
+                if state == self.USED and not (expires_at and expires_at <= now):
+                    keys.append(self.map[start:start + key_size])
+        return iter(fnmatch.filter(keys, match))
+
+    def cache_set(self, key, val, duration=60*60):
+        key, val = self._encode(key, val)
+        with self.locked(True):
+            if duration is not None and duration <= 0:
+                self._delete(key, time.time())
+            else:
+                self._write(key, val, duration, time.time())
+
+    def cache_set_many(self, mapping, duration=60*60):
+        items = [self._encode(key, val) for key, val in mapping.iteritems()]
+        with self.locked(True):
+            now = time.time()
+            for key, val in items:
+                self._write(key, val, duration, now)
+
+    def delete(self, key):
+        key = encode_key(key)
+        with self.locked(True):
+            self._delete(key, time.time())
+
+    def lock(self, key, ttl):
+        token = uuid.uuid4().hex
+        key, _ = self._encode(key, token)
+        with self.locked(True):
+            now = time.time()
+            if self._read(key, now)[0] is not None:
+                return None
+            self._write(key, token, ttl, now)
+        return token
+
+    def unlock(self, key, token):
+        key = encode_key(key)
+        with self.locked(True):
+            now = time.time()
+            if self._read(key, now)[0] == token:
+                self._delete(key, now)
+
+
+
+class CachedStore(object):
+    """In-process L1 cache in front of a store's cache_get/cache_set.
+
+    Values read from the store are kept for the lifetime they have left
+    there, values written for the duration passed to cache_set. Everything
+    else is delegated to the wrapped store.
+    """
+
+    def __init__(self, store, max_entries=10000, max_bytes=16 * 1024 * 1024):
+        self.store = store
+        self.local = LRUCache(max_entries=max_entries, max_bytes=max_bytes)
+
+    def __getattr__(self, name):
+        return getattr(self.store, name)
+
+    def cache_get(self, key):
+        value, ttl = self.local.get_with_ttl(key)
+        if ttl is not None:
+            return value
+        value, ttl = self.store.cache_get_with_ttl(key)
+        if value is not None:
+            self.local.set(key, value, ttl)
+        return value
+
+    def cache_get_with_ttl(self, key):
+        value, ttl = self.local.get_with_ttl(key)
+        if ttl is not None:
+            return value, None if ttl == float("inf") else ttl
+        value, ttl = self.store.cache_get_with_ttl(key)
+        if value is not None:
+            self.local.set(key, value, ttl)
+        return value, ttl
+
+    def cache_get_many(self, keys):
+        values = [self.local.get_with_ttl(key) for key in keys]
+        missing = [key for key, (_, ttl) in zip(keys, values) if ttl is None]
+        if not missing:
+            return [value for value, _ in values]
+        fetched = dict(zip(missing, self.store.cache_get_many_with_ttl(missing)))
+        result = []
+        for key, (value, ttl) in zip(keys, values):
+            if ttl is None:
+                value, ttl = fetched[key]
+                if value is not None:
+                    self.local.set(key, value, ttl)
+            result.append(value)
+        return result
+
+    def cache_set(self, key, val, duration=60*60):
+        self.store.cache_set(key, val, duration)
+        self.local.set(key, val, duration)
+
+    def cache_set_many(self, mapping, duration=60*60):
+        self.store.cache_set_many(mapping, duration)
+        for key, val in mapping.iteritems():
+            self.local.set(key, val, duration)
+
+    def delete(self, key):
+        self.local.delete(key)
+        self.store.delete(key)
+
+    def cache_stats(self):
+        return self.local.stats()
+
+
+def add_store_options(op):
+    op.add_option("--store", action="store", choices=STORES, default="redis",
+                  help="redis, memory (per process) or mmap (a file shared by the processes of a host)")
+    op.add_option("--store-entries", action="store", type=int, default=DEFAULT_STORE_ENTRIES,
+                  help="entries of the memory and mmap stores")
+    op.add_option("--store-path", action="store", default=DEFAULT_STORE_PATH, help="file of the mmap store")
+    op.add_option("--store-slot-size", action="store", type=int, default=DEFAULT_SLOT_SIZE,
+                  help="bytes of a key and its value in the mmap store, with 13 bytes of header")
+    op.add_option("--redis-host", action="store", default=DEFAULT_HOST)
+    op.add_option("--redis-port", action="store", type=int, default=DEFAULT_PORT)
+    op.add_option("--redis-db", action="store", type=int, default=DEFAULT_DB)
+    op.add_option("--redis-timeout", action="store", type=float, default=DEFAULT_SOCKET_TIMEOUT,
+                  help="socket timeout of a redis command, seconds")
+    op.add_option("--redis-connect-timeout", action="store", type=float, default=DEFAULT_CONNECT_TIMEOUT)
+    op.add_option("--redis-max-connections", action="store", type=int, default=DEFAULT_MAX_CONNECTIONS,
+                  help="connection pool size per process, should cover --threads")
+    op.add_option("--redis-pool-timeout", action="store", type=float, default=DEFAULT_POOL_TIMEOUT,
+                  help="seconds to wait for a free pooled connection")
+    op.add_option("--redis-get-retries", action="store", type=int,
+                  default=DEFAULT_RETRY_POLICIES["get"].attempts)
+    op.add_option("--redis-get-deadline", action="store", type=float,
+                  default=DEFAULT_RETRY_POLICIES["get"].deadline)
+    op.add_option("--redis-cache-retries", action="store", type=int,
+                  default=DEFAULT_RETRY_POLICIES["cache"].attempts)
+    op.add_option("--redis-cache-deadline", action="store", type=float,
+                  default=DEFAULT_RETRY_POLICIES["cache"].deadline)
+    op.add_option("--redis-breaker-threshold", action="store", type=int, default=5,
+                  help="consecutive failures that open the circuit")
+    op.add_option("--redis-breaker-reset", action="store", type=float, default=5.0,
+                  help="seconds the circuit stays open before a trial call")
+    op.add_option("--l1-entries", action="store", type=int, default=0,
+                  help="entries of the in-process score cache, 0 disables it")
+    op.add_option("--l1-bytes", action="store", type=int, default=16 * 1024 * 1024)
+    op.add_option("--interests-snapshot", action="store", default=None,
+                  help="serve the interests from this file written by snapshot.py instead of the store")
+
+
+def store_from_options(opts):
+    if opts.store == "memory":
+        store = MemoryStore(max_entries=opts.store_entries)
+    elif opts.store == "mmap":
+        store = MmapStore(opts.store_path, slots=opts.store_entries, slot_size=opts.store_slot_size)
+    else:
+        store = redis_store_from_options(opts)
+    if opts.l1_entries > 0:
+        store = CachedStore(store, max_entries=opts.l1_entries, max_bytes=opts.l1_bytes)
+    if opts.interests_snapshot:
+        store = SnapshotStore(opts.interests_snapshot, store)
+    return store
+
+
+def redis_store_from_options(opts):
+    policies = {
+        "get": RetryPolicy(attempts=opts.redis_get_retries, deadline=opts.redis_get_deadline),
+        "cache": RetryPolicy(attempts=opts.redis_cache_retries, deadline=opts.redis_cache_deadline,
+                             base_delay=0.01, max_delay=0.05),
+    }
+    return RedisStore(host=opts.redis_host, port=opts.redis_port, db=opts.redis_db,
+                      socket_timeout=opts.redis_timeout, socket_connect_timeout=opts.redis_connect_timeout,
+                      max_connections=opts.redis_max_connections, pool_timeout=opts.redis_pool_timeout,
+                      retry_policies=policies,
+                      breaker=CircuitBreaker(opts.redis_breaker_threshold, opts.redis_breaker_reset))
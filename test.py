@@ -4,6 +4,7 @@ import functools
 import unittest
 
 import api
+import store
 
 
 def cases(cases):
@@ -21,10 +22,12 @@ class TestSuite(unittest.TestCase):
     def setUp(self):
         self.context = {}
         self.headers = {}
-        self.settings = {}
+        self.store = store.MemoryStore()
+        for cid in range(4):
+            self.store.set("i:%s" % cid, '["cars", "pets"]')
 
     def get_response(self, request):
-        return api.method_handler({"body": request, "headers": self.headers}, self.context, self.settings)
+        return api.method_handler({"body": request, "headers": self.headers}, self.context, self.store)
 
     def set_valid_auth(self, request):
         if request.get("login") == api.ADMIN_LOGIN:
@@ -0,0 +1,32 @@
+import pytest
+
+import benchmark
+from store import MemoryStore
+
+
+class TestBenchmark:
+
+    def test_parse_mix(self):
+        assert benchmark.parse_mix("online_score=3,invalid") == [("online_score", 3.0), ("invalid", 1.0)]
+        with pytest.raises(ValueError):
+            benchmark.parse_mix("unknown=1")
+
+    @pytest.mark.parametrize("fraction, result", [(0.5, 50), (0.95, 95), (0.99, 99), (1, 100), (0, 1)])
+    def test_percentile(self, fraction, result):
+        assert benchmark.percentile(range(1, 101), fraction) == result
+
+    @pytest.mark.parametrize("server_kind", ["threads", "event_loop"])
+    def test_run_reports_every_kind(self, server_kind):
+        store = MemoryStore()
+        benchmark.seed_interests(store, count=benchmark.CLIENT_IDS)
+        server = benchmark.start_server(server_kind, 2, store)
+        try:
+            report = benchmark.run("localhost", server.server_address[1], benchmark.parse_mix(benchmark.DEFAULT_MIX),
+                                   concurrency=2, duration=5, requests=40)
+        finally:
+            server.shutdown()
+            server.server_close()
+        assert report["total"]["requests"] == 40
+        assert report["total"]["errors"] == 0
+        assert report["total"]["p50_ms"] <= report["total"]["p99_ms"]
+        assert sum(kind["requests"] for kind in report["kinds"].values()) == 40
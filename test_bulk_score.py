@@ -0,0 +1,42 @@
+import pytest
+import json
+from cStringIO import StringIO
+
+import api
+import bulk_score
+
+
+class DictStore(object):
+    def __init__(self):
+        self.cached = {}
+
+    def cache_get_many(self, keys):
+        return [self.cached.get(key) for key in keys]
+
+    def cache_set_many(self, mapping, duration=60*60):
+        self.cached.update(mapping)
+
+
+LINES = [
+    {"phone": "79175002040", "email": "stupnikov@otus.ru"},
+    {"first_name": "a", "last_name": "b", "gender": 1, "birthday": "01.01.2000"},
+    {"phone": "89175002040", "email": "stupnikov@otus.ru"},
+    {"first_name": "a"},
+]
+
+
+class TestBulkScore:
+
+    @pytest.mark.parametrize("processes", [1, 2])
+    def test_streams_scores_in_input_order(self, processes):
+        lines = [json.dumps(line) for line in LINES * 5] + ["not json", "[1, 2]"]
+        output = StringIO()
+        rows = bulk_score.run(StringIO("\n".join(lines) + "\n\n"), output, DictStore,
+                              processes=processes, batch_size=3, progress_interval=0)
+        results = [json.loads(line) for line in output.getvalue().splitlines()]
+        assert rows == len(results) == 22
+        assert [result.get("score") for result in results[:4]] == [3.0, 2.0, None, None]
+        assert results[2] == {"error": api.INVALID_ARGS_MESSAGE + "phone", "code": api.INVALID_REQUEST}
+        assert results[3] == {"error": api.INSUFFICIENT_ARG_PAIRS_MESSAGE, "code": api.INVALID_REQUEST}
+        assert results[4:20] == results[:4] * 4
+        assert results[20:] == [{"error": api.ERRORS[api.BAD_REQUEST], "code": api.BAD_REQUEST}] * 2
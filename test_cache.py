@@ -0,0 +1,158 @@
+import pytest
+import time
+import threading
+
+from cache import LRUCache, SingleFlight
+from store import CachedStore
+
+
+class DictStore(object):
+    def __init__(self):
+        self.data = {}
+        self.reads = 0
+
+    def cache_get_with_ttl(self, key):
+        self.reads += 1
+        return self.data.get(key), 60
+
+    def cache_set(self, key, val, duration=60*60):
+        self.data[key] = val
+
+    def delete(self, key):
+        self.data.pop(key, None)
+
+    def get(self, key):
+        return "interests"
+
+
+
+class TestLRUCache:
+
+    def test_get_set(self):
+        cache = LRUCache(max_entries=2)
+        cache.set("a", 1)
+        assert cache.get("a") == 1
+        assert cache.get("b") is None
+        assert cache.stats()["hits"] == 1
+        assert cache.stats()["misses"] == 1
+
+    def test_evicts_least_recently_used(self):
+        cache = LRUCache(max_entries=2)
+        cache.set("a", 1)
+        cache.set("b", 2)
+        cache.get("a")
+        cache.set("c", 3)
+        assert "b" not in cache
+        assert "a" in cache and "c" in cache
+        assert cache.stats()["evictions"] == 1
+
+    def test_bounded_by_bytes(self):
+        cache = LRUCache(max_entries=100, max_bytes=300)
+        for i in range(10):
+            cache.set("key%s" % i, "x" * 50)
+        assert cache.bytes <= 300
+        assert len(cache) < 10
+
+    def test_entries_expire(self):
+        cache = LRUCache(ttl=0.05)
+        cache.set("a", 1)
+        cache.set("b", 2, ttl=10)
+        time.sleep(0.06)
+        assert cache.get("a") is None
+        assert cache.get("b") == 2
+        assert cache.stats()["expirations"] == 1
+
+    def test_get_with_ttl(self):
+        cache = LRUCache()
+        cache.set("a", 1, ttl=10)
+        cache.set("b", 2)
+        value, ttl = cache.get_with_ttl("a")
+        assert value == 1 and 9 < ttl <= 10
+        assert cache.get_with_ttl("b") == (2, float("inf"))
+        assert cache.get_with_ttl("c") == (None, None)
+
+
+
+class TestCachedStore:
+
+    def test_read_through(self):
+        backend = DictStore()
+        backend.data["uid:1"] = "3.0"
+        store = CachedStore(backend)
+        assert store.cache_get("uid:1") == "3.0"
+        assert store.cache_get("uid:1") == "3.0"
+        assert backend.reads == 1
+        assert store.cache_stats()["hits"] == 1
+
+    def test_write_through_and_delete(self):
+        backend = DictStore()
+        store = CachedStore(backend)
+        store.cache_set("uid:1", 5.0, 60)
+        assert backend.data["uid:1"] == 5.0
+        assert store.cache_get("uid:1") == 5.0
+        assert backend.reads == 0
+        store.delete("uid:1")
+        assert store.cache_get("uid:1") is None
+
+    def test_misses_are_not_cached(self):
+        backend = DictStore()
+        store = CachedStore(backend)
+        assert store.cache_get("uid:1") is None
+        assert store.cache_get("uid:1") is None
+        assert backend.reads == 2
+
+    def test_read_through_with_ttl(self):
+        backend = DictStore()
+        backend.data["uid:1"] = "3.0"
+        store = CachedStore(backend)
+        assert store.cache_get_with_ttl("uid:1") == ("3.0", 60)
+        value, ttl = store.cache_get_with_ttl("uid:1")
+        assert value == "3.0" and 59 < ttl <= 60
+        assert backend.reads == 1
+
+    def test_delegates_other_calls(self):
+        assert CachedStore(DictStore()).get("i:1") == "interests"
+
+
+
+class TestSingleFlight:
+
+    def run_concurrently(self, flights, func, count=5):
+        results, errors = [], []
+
+        def call():
+            try:
+                results.append(flights.do("key", func))
+            except ValueError as e:
+                errors.append(e)
+
+        threads = [threading.Thread(target=call) for _ in range(count)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join(5)
+        return results, errors
+
+    def test_concurrent_calls_share_one_run(self):
+        flights, calls = SingleFlight(), []
+
+        def slow():
+            calls.append(1)
+            time.sleep(0.2)
+            return len(calls)
+
+        results, errors = self.run_concurrently(flights, slow)
+        assert calls == [1]
+        assert results == [1] * 5
+        assert flights.calls == {}
+        # later calls run again
+        assert flights.do("key", slow) == 2
+
+    def test_waiters_get_the_exception(self):
+        def failing():
+            time.sleep(0.2)
+            raise ValueError("failed")
+
+        results, errors = self.run_concurrently(SingleFlight(), failing)
+        assert results == []
+        assert len(errors) == 5
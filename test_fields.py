@@ -1,5 +1,8 @@
 import pytest
-from api import ADMIN_LOGIN, MethodRequest, OnlineScoreRequest, ClientsInterestsRequest
+import datetime
+import threading
+
+from api import ADMIN_LOGIN, BaseField, MethodRequest, OnlineScoreRequest, ClientsInterestsRequest, parse_date
 
 
 
@@ -258,4 +261,69 @@ class TestClientInterestRequest:
     def test_has_date_field_failure(self, value):
         arguments = {'date': value}
         request = ClientsInterestsRequest(arguments)
-        assert request.has_date is False
\ No newline at end of file
+        assert request.has_date is False
+
+
+class TestFieldStorage:
+
+    def test_values_are_stored_per_instance(self):
+        first = OnlineScoreRequest({'first_name': "Yeldos", 'birthday': "01.01.1990"})
+        second = OnlineScoreRequest({'first_name': "Dima"})
+        assert first.first_name == "Yeldos"
+        assert second.first_name == "Dima"
+        assert first.birthday == datetime.datetime(1990, 1, 1)
+        assert second.birthday is None
+
+    def test_requests_have_no_instance_dict(self):
+        request = MethodRequest({'login': "h&f"})
+        assert not hasattr(request, '__dict__')
+        assert isinstance(MethodRequest.login, BaseField)
+
+    def test_concurrent_requests_do_not_share_fields(self):
+        errors = []
+
+        def validate(login):
+            for _ in range(200):
+                request = MethodRequest({'login': login})
+                if request.login != login:
+                    errors.append(login)
+
+        threads = [threading.Thread(target=validate, args=("user%s" % i,)) for i in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        assert errors == []
+
+    def test_fields_are_compiled_in_declaration_order(self):
+        assert [field.name for field in MethodRequest._fields] == \
+            ['account', 'login', 'token', 'arguments', 'method']
+        assert [field.name for field in ClientsInterestsRequest._fields] == ['client_ids', 'date']
+
+    def test_invalid_fields_follow_declaration_order(self):
+        request = MethodRequest({'method': ""})
+        assert request.invalid_fields == ['login', 'token', 'arguments', 'method']
+        assert request.has_fields == ['account']
+
+
+
+class TestDateParsing:
+
+    @pytest.mark.parametrize("value", ["01.01.2000", "1.1.2000", "31.12.1999", "29.02.2016", "09.7.2017"])
+    def test_parse_date_matches_strptime(self, value):
+        assert parse_date(value) == datetime.datetime.strptime(value, '%d.%m.%Y')
+
+    @pytest.mark.parametrize("value", ["XXX", "201.10.10", "1980.10.10", "16-12-1980", "29.02.2017",
+                                       "00.01.2000", "01.13.2000", "01.01.20000", "01.01.2000 ", "01.01.2000\n"])
+    def test_parse_date_rejects_like_strptime(self, value):
+        with pytest.raises(ValueError):
+            datetime.datetime.strptime(value, '%d.%m.%Y')
+        with pytest.raises(ValueError):
+            parse_date(value)
+
+    def test_birthday_cutoff(self):
+        today = datetime.date.today()
+        cutoff = datetime.datetime(today.year - 70, today.month, today.day if (today.month, today.day) != (2, 29) else 28)
+        oldest = cutoff + datetime.timedelta(days=1)
+        assert 'birthday' in OnlineScoreRequest({'birthday': cutoff.strftime("%d.%m.%Y")}).invalid_fields
+        assert 'birthday' not in OnlineScoreRequest({'birthday': oldest.strftime("%d.%m.%Y")}).invalid_fields
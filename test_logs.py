@@ -0,0 +1,84 @@
+import pytest
+import json
+import logging
+import datetime
+from cStringIO import StringIO
+
+import logs
+
+
+@pytest.fixture
+def logger():
+    stream = StringIO()
+    target = logging.StreamHandler(stream)
+    target.setFormatter(logs.JSONFormatter(field_limit=20))
+    handler = logs.QueueHandler([target], queue_size=10)
+    logger = logging.getLogger("test_logs")
+    logger.propagate = False
+    logger.setLevel(logging.INFO)
+    logger.addHandler(handler)
+    yield logger, handler, stream
+    logger.removeHandler(handler)
+    handler.close()
+
+
+def read_lines(handler, stream):
+    handler.writer.stop()
+    handler.writer = None
+    return [json.loads(line) for line in stream.getvalue().splitlines()]
+
+
+
+class TestLogPipeline:
+
+    def test_writes_json_lines_in_background(self, logger):
+        logger, handler, stream = logger
+        logger.info("response", extra={"fields": {"code": 200, "request_id": "abc"}})
+        lines = read_lines(handler, stream)
+        assert len(lines) == 1
+        assert (lines[0]["message"], lines[0]["level"], lines[0]["code"], lines[0]["request_id"]) == \
+            ("response", "INFO", 200, "abc")
+
+    def test_long_fields_are_truncated(self, logger):
+        logger, handler, stream = logger
+        logger.info("response", extra={"fields": {"body": "x" * 100, "response": {"a": "y" * 100}, "n": [1]}})
+        line = read_lines(handler, stream)[0]
+        assert line["body"] == "x" * 20 + "...[80 more]"
+        assert line["response"].startswith('{"a": "yyy') and line["response"].endswith("more]")
+        assert line["n"] == [1]
+
+    def test_unserializable_fields_are_logged_as_repr(self, logger):
+        logger, handler, stream = logger
+        logger.info("response", extra={"fields": {"time": datetime.time(1), "big": {1j: "z" * 100}}})
+        line = read_lines(handler, stream)[0]
+        assert line["time"] == "datetime.time(1, 0)"
+        assert line["big"].startswith("{1j: 'zzz") and line["big"].endswith("more]")
+
+    def test_exceptions_are_formatted_before_queueing(self, logger):
+        logger, handler, stream = logger
+        try:
+            raise ValueError("boom")
+        except ValueError:
+            logger.exception("failed")
+        line = read_lines(handler, stream)[0]
+        assert "ValueError: boom" in line["exception"]
+
+    def test_drops_records_when_queue_is_full(self, logger):
+        logger, handler, stream = logger
+        logger.info("first")
+        handler.writer.stop()
+        handler.writer = None
+        for _ in range(15):
+            logger.info("queued")
+        assert handler.dropped == 5
+
+    def test_body_sampling(self, monkeypatch):
+        monkeypatch.setattr(logs, "BODY_SAMPLE_RATE", 0)
+        assert not any(logs.should_log_body() for _ in range(100))
+        monkeypatch.setattr(logs, "BODY_SAMPLE_RATE", 1)
+        assert all(logs.should_log_body() for _ in range(100))
+
+    def test_truncate(self):
+        assert logs.truncate("abc", 5) == "abc"
+        assert logs.truncate("abcdef", 2) == "ab...[4 more]"
+        assert logs.truncate(None, 2) is None
@@ -0,0 +1,44 @@
+import os
+import pytest
+
+import metrics
+
+
+@pytest.fixture
+def histogram():
+    return metrics.Histogram("test_seconds", "Test histogram.", "stage", buckets=(0.1, 1))
+
+
+class TestHistogram:
+
+    def test_buckets_are_cumulative(self, histogram):
+        for value in (0.05, 0.1, 0.5, 2):
+            histogram.observe("a", value)
+        counts, total = histogram.snapshot()["a"]
+        assert counts == [2, 3, 4]
+        assert total == pytest.approx(2.65)
+
+    def test_render(self, histogram):
+        histogram.observe("a", 0.5)
+        labels = 'pid="%s",stage="a"' % os.getpid()
+        assert histogram.render().splitlines() == [
+            "# HELP test_seconds Test histogram.",
+            "# TYPE test_seconds histogram",
+            'test_seconds_bucket{%s,le="0.1"} 0' % labels,
+            'test_seconds_bucket{%s,le="1"} 1' % labels,
+            'test_seconds_bucket{%s,le="+Inf"} 1' % labels,
+            'test_seconds_sum{%s} 0.500000000' % labels,
+            'test_seconds_count{%s} 1' % labels,
+        ]
+
+    def test_timed_records_failures(self, histogram):
+        with pytest.raises(ValueError):
+            with metrics.timed("failing", histogram):
+                raise ValueError()
+
+        @metrics.timed_function("function", histogram)
+        def function():
+            return 1
+
+        assert function() == 1
+        assert set(histogram.snapshot()) == {"failing", "function"}
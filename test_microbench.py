@@ -0,0 +1,21 @@
+import json
+
+import microbench
+
+
+class TestMicrobench:
+
+    def test_cases_run(self):
+        results = microbench.run(number=10, repeat=1)
+        assert set(results) == set(microbench.cases())
+        assert all(result > 0 for result in results.values())
+
+    def test_baseline_covers_every_case(self):
+        with open(microbench.BASELINE) as f:
+            baseline = json.load(f)["results"]
+        assert set(baseline) == set(microbench.cases())
+
+    def test_compare_flags_slowdowns_only(self):
+        baseline = {"fast": 1.0, "slow": 1.0, "new": None}
+        results = {"fast": 1.1, "slow": 2.0, "unknown": 5.0}
+        assert microbench.compare(results, baseline, threshold=0.25) == [("slow", 1.0, 2.0, 1.0)]
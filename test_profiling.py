@@ -0,0 +1,55 @@
+import datetime
+import hashlib
+
+import pytest
+
+import api
+import profiling
+
+
+@pytest.fixture
+def sampled(monkeypatch, tmpdir):
+    monkeypatch.setattr(profiling, "SAMPLE_RATE", 1.0)
+    monkeypatch.setattr(profiling, "DIRECTORY", str(tmpdir))
+    monkeypatch.setattr(profiling, "_aggregate", profiling.Aggregate())
+    return tmpdir
+
+
+def echo_handler(request, context, store):
+    return sum(range(100)), api.OK
+
+
+class TestProfiling:
+
+    def test_disabled_by_default(self):
+        assert not profiling.enabled()
+        with profiling.profiled("id") as sampled:
+            assert sampled is False
+
+    def test_dump_is_tagged_with_request_ids(self, sampled):
+        for request_id in ("first", "second"):
+            code, r = api.handle_request({"echo": echo_handler}, "/echo/", {"HTTP_X_REQUEST_ID": request_id},
+                                         '{"a": 1}', None)
+            assert code == api.OK
+        path, requests = profiling.dump()
+        assert requests == 2
+        assert path.startswith(str(sampled))
+        report = open(path + ".txt").read()
+        assert "request_ids: first second" in report
+        assert "echo_handler" in report
+        # the aggregate starts over after a dump
+        assert profiling.dump() == (None, 0)
+
+    def test_endpoint_is_admin_only(self, sampled):
+        body = {"account": "horns&hoofs", "login": "h&f", "method": "dump", "arguments": {},
+                "token": hashlib.sha512("horns&hoofs" + "h&f" + api.SALT).hexdigest()}
+        response, code = api.profile_handler({"body": body, "headers": {}}, {}, None)
+        assert code == api.FORBIDDEN
+        body["login"] = api.ADMIN_LOGIN
+        response, code = api.profile_handler({"body": body, "headers": {}}, {}, None)
+        assert code == api.FORBIDDEN
+        body["token"] = hashlib.sha512(datetime.datetime.now().strftime("%Y%m%d%H") + api.ADMIN_SALT).hexdigest()
+        response, code = api.profile_handler({"body": body, "headers": {}}, {}, None)
+        assert code == api.OK
+        # the dumping request itself is not profiled, it did not go through handle_request
+        assert response["requests"] == 0
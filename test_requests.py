@@ -1,5 +1,6 @@
 import pytest
 import hashlib
+import time
 import datetime
 
 import api
@@ -52,6 +53,34 @@ class TestResponse:
         request = MethodRequest(data)
         assert not check_auth(request)
 
+    def test_token_digest_is_memoized(self, data):
+        data['token'] = generate_token(data, False)
+        assert check_auth(MethodRequest(data))
+        assert api._auth_digests.get((data['account'], data['login'])) == data['token']
+        assert check_auth(MethodRequest(data))
+
+    def test_unicode_token_is_accepted(self, data):
+        data['token'] = unicode(generate_token(data, False))
+        assert check_auth(MethodRequest(data))
+        data['token'] = u"\u0442\u043e\u043a\u0435\u043d"
+        assert not check_auth(MethodRequest(data))
+
+    def test_admin_digest_is_computed_once_per_minute(self, data):
+        data['login'] = ADMIN_LOGIN
+        data['token'] = generate_token(data, True)
+        before = int(time.time()) // 60
+        assert check_auth(MethodRequest(data))
+        minute, digest = api._admin_digest
+        # the call may cross a minute boundary
+        assert minute in (before, int(time.time()) // 60)
+        assert digest == data['token']
+
+    def test_only_matching_tokens_are_memoized(self, data):
+        data['login'] = "memo-%s" % id(data)
+        data['token'] = "super_unique_token"
+        assert not check_auth(MethodRequest(data))
+        assert (data['account'], data['login']) not in api._auth_digests
+
     @pytest.mark.parametrize("field_name, field_value, expected_response, expected_code", [
         ("account", "horns&hoofs", {'score': 5.0}, 200),
         ("method", "unknown_method", api.ERRORS[api.INVALID_REQUEST], api.INVALID_REQUEST),
@@ -89,3 +118,68 @@ class TestResponse:
 
     def test_final_response_is_generated_correctly(self):
         pass
+
+
+
+class BatchStore(object):
+    def __init__(self, cached=None):
+        self.cached = cached or {}
+        self.reads = []
+        self.writes = []
+
+    def cache_get_many(self, keys):
+        self.reads.append(keys)
+        return [self.cached.get(key) for key in keys]
+
+    def cache_set_many(self, mapping, duration=60*60):
+        self.writes.append(mapping)
+        self.cached.update(mapping)
+
+
+class TestOnlineScoreBatch:
+
+    @pytest.fixture
+    def batch(self, data):
+        data['method'] = "online_score_batch"
+        data['token'] = generate_token(data, False)
+        data['arguments'] = {"items": [
+            {"phone": "79175002040", "email": "yeldos@balgabekov.com"},
+            {"phone": "89175002040", "email": "yeldos@balgabekov.com"},
+            {"first_name": "Yeldos"},
+            {"first_name": "Yeldos", "last_name": "Balgabekov", "gender": 1, "birthday": "01.01.1990"},
+        ]}
+        return data
+
+    def test_scores_items_and_reports_errors_per_item(self, batch):
+        store = BatchStore()
+        context = {}
+        response, code = Response(MethodRequest(batch), context, store).get_response()
+        assert code == api.OK
+        scores = response["scores"]
+        assert scores[0] == {"score": 3.0}
+        assert scores[1] == {"error": api.INVALID_ARGS_MESSAGE + "phone", "code": api.INVALID_REQUEST}
+        assert scores[2] == {"error": api.INSUFFICIENT_ARG_PAIRS_MESSAGE, "code": api.INVALID_REQUEST}
+        assert scores[3] == {"score": 2.0}
+        assert context['nitems'] == 4
+        assert len(store.reads) == 1 and len(store.reads[0]) == 2
+        assert len(store.writes) == 1 and len(store.writes[0]) == 2
+
+    def test_uses_cached_scores(self, batch):
+        store = BatchStore()
+        Response(MethodRequest(batch), {}, store)
+        store.cached = dict((key, "4.5") for key in store.cached)
+        response, code = Response(MethodRequest(batch), {}, store).get_response()
+        assert [item.get("score") for item in response["scores"]] == [4.5, None, None, 4.5]
+        assert len(store.writes) == 1
+
+    def test_admin_scores_42(self, batch):
+        batch['login'] = ADMIN_LOGIN
+        response, code = Response(MethodRequest(batch), {}, BatchStore()).get_response()
+        assert [item.get("score") for item in response["scores"]] == [42, None, None, 42]
+
+    @pytest.mark.parametrize("items", [[], "items", [1, 2], [{}] * (api.MAX_BATCH_SIZE + 1)])
+    def test_invalid_batch(self, batch, items):
+        batch['arguments'] = {"items": items}
+        response, code = Response(MethodRequest(batch), {}, BatchStore()).get_response()
+        assert code == api.INVALID_REQUEST
+        assert response == api.INVALID_ARGS_MESSAGE + "items"
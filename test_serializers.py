@@ -0,0 +1,54 @@
+# -*- coding: utf-8 -*-
+import pytest
+
+import serializers
+
+
+@pytest.fixture(params=sorted(serializers.JSON_BACKENDS))
+def backend(request):
+    previous = serializers.JSON_BACKEND
+    serializers.use_json(request.param)
+    yield request.param
+    serializers.use_json(previous)
+
+
+class TestJSON:
+
+    def test_round_trip(self, backend):
+        value = {"code": 200, "response": {"1": ["cars", u"кино"], "score": 3.5}}
+        assert serializers.loads(serializers.dumps(value)) == value
+
+    def test_invalid_body(self, backend):
+        with pytest.raises(ValueError):
+            serializers.loads("{not json")
+
+    def test_unknown_backend(self):
+        with pytest.raises(ValueError):
+            serializers.use_json("unknown")
+
+
+class TestInterests:
+
+    def test_legacy_json_values(self):
+        assert serializers.decode_interests('["cars", "pets"]') == ["cars", "pets"]
+        assert serializers.decode_interests(None) == []
+
+    def test_json_round_trip(self):
+        assert serializers.decode_interests(serializers.encode_interests(["cars", "pets"])) == ["cars", "pets"]
+
+    @pytest.mark.skipif(serializers.msgpack is None, reason="msgpack is not installed")
+    def test_msgpack_round_trip(self):
+        raw = serializers.encode_interests([u"cars", u"кино"], "msgpack")
+        assert raw.startswith(serializers.MARKER + serializers.MSGPACK_V1)
+        assert serializers.decode_interests(raw) == [u"cars", u"кино"]
+
+    @pytest.mark.skipif(serializers.msgpack is not None, reason="msgpack is installed")
+    def test_msgpack_is_optional(self):
+        with pytest.raises(RuntimeError):
+            serializers.encode_interests(["cars"], "msgpack")
+
+    def test_unknown_format(self):
+        with pytest.raises(ValueError):
+            serializers.encode_interests(["cars"], "xml")
+        with pytest.raises(ValueError):
+            serializers.decode_interests(serializers.MARKER + "\x7f")
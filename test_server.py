@@ -0,0 +1,178 @@
+import pytest
+import os
+import json
+import httplib
+import threading
+import time
+
+import api
+from async_server import AsyncHTTPServer
+
+
+@pytest.fixture
+def server():
+    server = api.make_server(0, threads=2)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+def post(server, path, body):
+    conn = httplib.HTTPConnection("localhost", server.server_address[1], timeout=5)
+    conn.request("POST", path, json.dumps(body), {"Content-Type": "application/json"})
+    response = conn.getresponse()
+    data = json.loads(response.read())
+    conn.close()
+    return response.status, data
+
+
+
+class TestThreadPoolHTTPServer:
+
+    def test_serves_requests_on_pool(self, server):
+        body = {"account": "horns&hoofs", "login": "h&f", "method": "unknown_method",
+                "token": "a_token", "arguments": {}}
+        for _ in range(5):
+            status, data = post(server, "/method/", body)
+            assert status == api.INVALID_REQUEST
+            assert data["code"] == api.INVALID_REQUEST
+        assert len(server.workers) == 2
+
+    def test_unknown_path(self, server):
+        status, data = post(server, "/unknown/", {"a": 1})
+        assert status == api.NOT_FOUND
+
+
+
+class TestAsyncHTTPServer:
+
+    @pytest.fixture
+    def server(self):
+        server = AsyncHTTPServer(("localhost", 0), threads=2)
+        thread = threading.Thread(target=server.serve_forever, args=(0.05,))
+        thread.daemon = True
+        thread.start()
+        yield server
+        server.shutdown()
+        thread.join(1)
+        server.server_close()
+
+    def test_serves_requests_on_event_loop(self, server):
+        body = {"account": "horns&hoofs", "login": "h&f", "method": "unknown_method",
+                "token": "a_token", "arguments": {}}
+        for _ in range(5):
+            status, data = post(server, "/method/", body)
+            assert status == api.INVALID_REQUEST
+            assert data["code"] == api.INVALID_REQUEST
+
+    def test_unknown_path(self, server):
+        status, data = post(server, "/unknown/", {"a": 1})
+        assert status == api.NOT_FOUND
+
+    def test_bad_request(self, server):
+        conn = httplib.HTTPConnection("localhost", server.server_address[1], timeout=5)
+        conn.request("POST", "/method/", "{not json", {"Content-Type": "application/json"})
+        assert conn.getresponse().status == api.BAD_REQUEST
+        conn.close()
+
+
+
+class TestKeepAlive:
+
+    body = json.dumps({"account": "horns&hoofs", "login": "h&f", "method": "unknown_method",
+                       "token": "a_token", "arguments": {}})
+
+    @pytest.fixture(params=["threads", "event_loop"])
+    def server(self, request, monkeypatch):
+        if request.param == "threads":
+            monkeypatch.setattr(api.MainHTTPHandler, "max_requests", 3)
+            monkeypatch.setattr(api.MainHTTPHandler, "timeout", 0.2)
+            server = api.make_server(0, threads=2)
+        else:
+            server = AsyncHTTPServer(("localhost", 0), threads=2, keepalive_timeout=0.2, max_requests=3)
+        thread = threading.Thread(target=server.serve_forever, args=(0.05,))
+        thread.daemon = True
+        thread.start()
+        yield server
+        server.shutdown()
+        thread.join(1)
+        server.server_close()
+
+    def request(self, conn):
+        conn.request("POST", "/method/", self.body, {"Content-Type": "application/json"})
+        response = conn.getresponse()
+        data = response.read()
+        assert int(response.getheader("content-length")) == len(data)
+        assert json.loads(data)["code"] == api.INVALID_REQUEST
+        return response.getheader("connection")
+
+    def test_connection_is_reused_until_max_requests(self, server):
+        conn = httplib.HTTPConnection("localhost", server.server_address[1], timeout=5)
+        self.request(conn)
+        sock = conn.sock
+        self.request(conn)
+        assert conn.sock is sock
+        assert self.request(conn) == "close"
+        conn.close()
+
+    def test_idle_connection_is_closed(self, server):
+        conn = httplib.HTTPConnection("localhost", server.server_address[1], timeout=5)
+        self.request(conn)
+        time.sleep(1.3)
+        assert conn.sock.recv(1) == ""
+        conn.close()
+
+    def test_serial_server_closes_every_connection(self):
+        server = api.make_server(0)
+        thread = threading.Thread(target=server.serve_forever, args=(0.05,))
+        thread.daemon = True
+        thread.start()
+        try:
+            idle = httplib.HTTPConnection("localhost", server.server_address[1], timeout=5)
+            assert self.request(idle) == "close"
+            # httplib drops the socket of a response with Connection: close
+            assert idle.sock is None
+            started = time.time()
+            other = httplib.HTTPConnection("localhost", server.server_address[1], timeout=5)
+            self.request(other)
+            assert time.time() - started < 1
+            idle.close()
+            other.close()
+        finally:
+            server.shutdown()
+            thread.join(1)
+            server.server_close()
+
+
+class TestMetricsEndpoint:
+
+    @pytest.fixture(params=["threads", "event_loop"])
+    def server(self, request):
+        if request.param == "threads":
+            server = api.make_server(0, threads=2)
+        else:
+            server = AsyncHTTPServer(("localhost", 0), threads=2)
+        thread = threading.Thread(target=server.serve_forever, args=(0.05,))
+        thread.daemon = True
+        thread.start()
+        yield server
+        server.shutdown()
+        thread.join(1)
+        server.server_close()
+
+    def test_stages_are_exposed(self, server):
+        body = {"account": "horns&hoofs", "login": "h&f", "method": "online_score",
+                "token": "a_token", "arguments": {"phone": "89175002040"}}
+        post(server, "/method/", body)
+        conn = httplib.HTTPConnection("localhost", server.server_address[1], timeout=5)
+        conn.request("GET", "/metrics")
+        response = conn.getresponse()
+        text = response.read()
+        conn.close()
+        assert response.status == api.OK
+        assert response.getheader("content-type").startswith("text/plain")
+        for stage in ("read_body", "parse", "validate", "process", "serialize"):
+            assert 'api_stage_duration_seconds_count{pid="%s",stage="%s"}' % (os.getpid(), stage) in text
@@ -0,0 +1,113 @@
+# -*- coding: utf-8 -*-
+import os
+import pytest
+
+import scoring
+import snapshot
+from store import MemoryStore
+from serializers import encode_interests
+
+
+INTERESTS = [(3, ["cars", "pets"]), (1, [u"кино", "cars"]), (-7, []), (2 ** 40, ["pets"])]
+
+
+@pytest.fixture(params=["numpy", "bisect"])
+def path(request, tmpdir, monkeypatch):
+    if request.param == "bisect":
+        monkeypatch.setattr(snapshot, "numpy", None)
+    elif snapshot.numpy is None:
+        pytest.skip("numpy is not installed")
+    path = str(tmpdir.join("interests.snapshot"))
+    snapshot.write_snapshot(path, INTERESTS)
+    return path
+
+
+class TestInterestsSnapshot:
+
+    def test_lookups(self, path):
+        interests = snapshot.InterestsSnapshot(path)
+        assert len(interests) == 4
+        for cid, values in INTERESTS:
+            assert interests.get(cid) == values
+        assert interests.get(2) == []
+        assert interests.get(2 ** 41) == []
+
+    def test_get_many(self, path):
+        interests = snapshot.InterestsSnapshot(path)
+        assert interests.get_many([2 ** 40, 0, 1, 3, 1]) == [["pets"], [], [u"кино", "cars"], ["cars", "pets"],
+                                                            [u"кино", "cars"]]
+        assert interests.get_many([]) == []
+
+    def test_ids_are_read_like_keys(self, path):
+        interests = snapshot.InterestsSnapshot(path)
+        # i:1 and i:3 are in the snapshot, i:1.5, i:1.0, i:01, i:True or i:(3,) are not
+        cids = ["1", u"3", 1.5, 1.0, "01", " 1", True, (3,), 2 ** 70, -2 ** 70, 2 ** 64 + 1]
+        expected = [[u"кино", "cars"], ["cars", "pets"]] + [[]] * 9
+        assert interests.get_many(cids) == expected
+        assert [interests.get(cid) for cid in cids] == expected
+
+    def test_strings_are_interned(self, path):
+        interests = snapshot.InterestsSnapshot(path)
+        assert sorted(interests.strings) == sorted([u"кино", u"cars", u"pets"])
+        assert interests.get(1)[1] is interests.get(3)[0]
+
+    def test_empty(self, tmpdir):
+        path = str(tmpdir.join("empty.snapshot"))
+        assert snapshot.write_snapshot(path, []) == 0
+        assert snapshot.InterestsSnapshot(path).get_many([1, 2]) == [[], []]
+
+    def test_duplicate_clients(self, tmpdir):
+        with pytest.raises(ValueError):
+            snapshot.write_snapshot(str(tmpdir.join("dup.snapshot")), [(1, ["cars"]), (1, ["pets"])])
+
+    def test_rejects_other_ids(self, tmpdir):
+        for cid in (1.5, 2 ** 63, "a"):
+            with pytest.raises(ValueError):
+                snapshot.write_snapshot(str(tmpdir.join("bad.snapshot")), [(cid, ["cars"])])
+
+    def test_rejects_other_interests(self, tmpdir):
+        for values in ({"value": "name"}, [1, 2], "cars", None):
+            with pytest.raises(ValueError) as error:
+                snapshot.write_snapshot(str(tmpdir.join("bad.snapshot")), [(3, ["cars"]), (7, values)])
+            assert "client 7" in str(error.value)
+
+    def test_rejects_other_files(self, tmpdir):
+        path = tmpdir.join("other")
+        path.write("x" * 64)
+        with pytest.raises(ValueError):
+            snapshot.InterestsSnapshot(str(path))
+
+    def test_rejects_truncated_files(self, path):
+        with open(path, "r+b") as f:
+            f.truncate(os.path.getsize(path) - 1)
+        with pytest.raises(ValueError):
+            snapshot.InterestsSnapshot(path)
+
+
+class TestSnapshotStore:
+
+    def test_serves_interests_and_delegates_the_rest(self, path):
+        backend = MemoryStore()
+        backend.set("i:3", '["books"]')
+        store = snapshot.SnapshotStore(path, backend)
+        assert scoring.get_interests(store, 3) == ["cars", "pets"]
+        assert scoring.get_interests_many(store, [1, 5]) == [[u"кино", "cars"], []]
+        store.cache_set("uid:1", 1.5)
+        assert store.cache_get("uid:1") == "1.5"
+
+    def test_picks_up_a_new_export(self, path):
+        store = snapshot.SnapshotStore(path, MemoryStore(), check_interval=0)
+        snapshot.write_snapshot(path, [(5, ["tv"])])
+        assert store.interests_many([5, 3]) == [["tv"], []]
+
+    def test_export_from_a_store(self, tmpdir):
+        backend = MemoryStore()
+        for cid, values in INTERESTS:
+            backend.set("i:%s" % cid, encode_interests(values))
+        backend.set("i:bad", "[]")
+        backend.set("i:03", "[]")
+        backend.cache_set("uid:1", 1.5)
+        path = str(tmpdir.join("exported.snapshot"))
+        assert snapshot.write_snapshot(path, snapshot.read_interests(backend, batch_size=3)) == 4
+        interests = snapshot.InterestsSnapshot(path)
+        assert [interests.get(cid) for cid, _ in INTERESTS] == [values for _, values in INTERESTS]
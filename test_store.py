@@ -1,7 +1,15 @@
+# -*- coding: utf-8 -*-
 import pytest
-from store import Store
+import os
+import redis
+from store import Store, CountingConnectionPool, RetryPolicy, CircuitBreaker, CircuitOpenError, PoolExhaustedError, \
+    MemoryStore, MmapStore
 import time
-from scoring import get_score, get_interests
+import threading
+import api
+import scoring
+import snapshot
+from scoring import get_score, get_interests, get_interests_many, calc_score, calc_scores, score_columns
 import hashlib
 import datetime
 
@@ -98,4 +106,483 @@ class TestGetInterests:
         assert get_interests(s, cid) == result
         s.delete("i:%s" % cid)
 
+    def test_get_interests_many_keeps_order_and_missing(self, s):
+        s.cache_set("i:1", '["cars"]')
+        s.cache_set("i:3", '["pets", "music"]')
+        assert get_interests_many(s, [3, 2, 1]) == [["pets", "music"], [], ["cars"]]
+        s.delete("i:1")
+        s.delete("i:3")
 
+    def test_get_interests_many_uses_one_round_trip(self):
+        class FakeStore(object):
+            calls = []
+
+            def get_many(self, keys):
+                self.calls.append(keys)
+                return ['["cars"]' if key == "i:1" else None for key in keys]
+
+        store = FakeStore()
+        assert get_interests_many(store, [1, 2]) == [["cars"], []]
+        assert store.calls == [["i:1", "i:2"]]
+        assert get_interests_many(store, []) == []
+
+
+
+class FakeConnection(object):
+    def __init__(self, **kwargs):
+        self.pid = os.getpid()
+
+    def connect(self):
+        pass
+
+    def can_read(self):
+        return False
+
+    def disconnect(self):
+        pass
+
+
+class RefusedConnection(FakeConnection):
+    refuse = False
+
+    def connect(self):
+        if self.refuse:
+            raise redis.ConnectionError("refused")
+
+
+class TestConnectionPool:
+
+    def test_store_uses_configured_pool(self):
+        store = Store(host="redis.local", port=6380, db=2, socket_timeout=0.5, max_connections=7)
+        kwargs = store.pool.connection_kwargs
+        assert (kwargs["host"], kwargs["port"], kwargs["db"], kwargs["socket_timeout"]) == \
+            ("redis.local", 6380, 2, 0.5)
+        assert store.pool_stats()["max_connections"] == 7
+
+    def test_pool_counts_utilization(self):
+        pool = CountingConnectionPool(connection_class=FakeConnection, max_connections=2, timeout=0.01)
+        first = pool.get_connection("GET")
+        second = pool.get_connection("GET")
+        assert pool.stats()["in_use"] == 2
+        with pytest.raises(redis.ConnectionError):
+            pool.get_connection("GET")
+        pool.release(first)
+        pool.release(second)
+        stats = pool.stats()
+        assert (stats["in_use"], stats["peak_in_use"], stats["checkouts"], stats["created"]) == (0, 2, 2, 2)
+
+    def test_failed_connects_are_not_counted(self):
+        pool = CountingConnectionPool(connection_class=RefusedConnection, max_connections=2, timeout=0.01)
+        first = pool.get_connection("GET")
+        RefusedConnection.refuse = True
+        try:
+            with pytest.raises(redis.ConnectionError):
+                pool.get_connection("GET")
+        finally:
+            RefusedConnection.refuse = False
+        assert pool.stats()["in_use"] == 1
+        pool.release(first)
+        assert pool.stats()["in_use"] == 0
+
+
+
+class FlakyConnection(object):
+    def __init__(self, failures):
+        self.failures = failures
+        self.calls = 0
+
+    def get(self, key):
+        self.calls += 1
+        if self.calls <= self.failures:
+            raise redis.ConnectionError
+        return "value"
+
+
+class TestRetryPolicy:
+
+    def make_store(self, failures, attempts=3, threshold=5):
+        store = Store(retry_policies={"get": RetryPolicy(attempts=attempts, base_delay=0.001, deadline=1),
+                                      "cache": RetryPolicy(attempts=1, deadline=1)},
+                      breaker=CircuitBreaker(failure_threshold=threshold, reset_timeout=60))
+        store.conn = FlakyConnection(failures)
+        return store
+
+    def test_retries_until_success(self):
+        store = self.make_store(failures=2)
+        assert store.get("key") == "value"
+        assert store.conn.calls == 3
+
+    def test_gives_up_after_attempts(self):
+        store = self.make_store(failures=10)
+        with pytest.raises(redis.ConnectionError):
+            store.get("key")
+        assert store.conn.calls == 3
+
+    def test_policy_is_per_operation(self):
+        store = self.make_store(failures=1)
+        with pytest.raises(redis.ConnectionError):
+            store.cache_get("key")
+        assert store.conn.calls == 1
+
+    def test_deadline_stops_retries(self):
+        store = self.make_store(failures=10, attempts=100)
+        store.policies["get"] = RetryPolicy(attempts=100, base_delay=0.05, max_delay=0.05, deadline=0.1)
+        started = time.time()
+        with pytest.raises(redis.ConnectionError):
+            store.get("key")
+        assert time.time() - started < 0.5
+
+    def test_open_circuit_fails_fast(self):
+        store = self.make_store(failures=10, threshold=2)
+        with pytest.raises(redis.ConnectionError):
+            store.get("key")
+        assert store.breaker.is_open
+        calls = store.conn.calls
+        with pytest.raises(CircuitOpenError):
+            store.get("key")
+        assert store.conn.calls == calls
+
+    def test_full_pool_is_not_retried_and_keeps_the_circuit_closed(self):
+        store = Store(max_connections=1, pool_timeout=5,
+                      retry_policies={"cache": RetryPolicy(attempts=3, base_delay=0.001, deadline=0.05)},
+                      breaker=CircuitBreaker(failure_threshold=1, reset_timeout=60))
+        store.pool.connection_class = FakeConnection
+        held = store.pool.get_connection("GET")
+        started = time.time()
+        for _ in range(3):
+            with pytest.raises(PoolExhaustedError):
+                store.cache_get("key")
+        # every wait is cut at the 0.05s deadline instead of the 5s pool timeout
+        assert time.time() - started < 1
+        assert (store.breaker.failures, store.breaker.is_open) == (0, False)
+        store.pool.release(held)
+
+    def test_circuit_closes_after_successful_trial(self):
+        breaker = CircuitBreaker(failure_threshold=1, reset_timeout=0)
+        breaker.record_failure()
+        assert breaker.is_open
+        assert breaker.allow()
+        breaker.record_success()
+        assert not breaker.is_open
+
+
+
+class TestCalcScores:
+
+    def test_vectorized_scores_match_calc_score(self):
+        numpy = pytest.importorskip("numpy")
+        values = {"phone": ["", "79175002040"], "email": ["", "a@b"], "birthday": [None, datetime.datetime(2000, 1, 1)],
+                  "gender": [None, 0, 1], "first_name": ["", "a"], "last_name": [None, "b"]}
+        items = [{}]
+        for name, options in sorted(values.items()):
+            items = [dict(item, **{name: option}) for item in items for option in options]
+        scores = calc_scores(*score_columns(items))
+        assert scores.dtype == numpy.float64
+        assert [float(score) for score in scores] == [float(calc_score(**item)) for item in items]
+        assert len(items) == 96
+
+    def test_columns_of_dicts_without_some_fields(self, monkeypatch):
+        for numpy in (scoring.numpy, None):
+            monkeypatch.setattr(scoring, "numpy", numpy)
+            assert [list(column) for column in score_columns([{"phone": "1", "email": ""}])] == \
+                [[True], [False], [False], [False]]
+
+
+
+class LockingStore(object):
+    """Shared by the threads of a test like redis is shared by processes."""
+
+    def __init__(self):
+        self.data = {}
+        self.locks = {}
+        self.writes = []
+
+    def cache_get(self, key):
+        return self.data.get(key)
+
+    def cache_set(self, key, val, duration=60*60):
+        self.writes.append(key)
+        self.data[key] = val
+
+    def lock(self, key, ttl):
+        if key in self.locks:
+            return None
+        self.locks[key] = "token"
+        return "token"
+
+    def unlock(self, key, token):
+        if self.locks.get(key) == token:
+            del self.locks[key]
+
+
+class TestScoreCoalescing:
+
+    @pytest.fixture
+    def slow_calc(self, monkeypatch):
+        calls = []
+
+        def slow(*args):
+            calls.append(args)
+            time.sleep(0.2)
+            return calc_score(*args)
+
+        monkeypatch.setattr(scoring, "calc_score", slow)
+        return calls
+
+    def test_concurrent_misses_share_one_computation(self, slow_calc):
+        store, results = LockingStore(), []
+        threads = [threading.Thread(target=lambda: results.append(get_score(store, "79175002040", "a@b")))
+                   for _ in range(5)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join(5)
+        assert results == [3.0] * 5
+        assert len(slow_calc) == 1
+        assert len(store.writes) == 1
+
+    def test_waits_for_the_lock_holder(self, slow_calc, monkeypatch):
+        monkeypatch.setattr(scoring, "SCORE_LOCK_TTL", 1.0)
+        store = LockingStore()
+        key = scoring.get_score_key()
+        # another process holds the lock and writes the score a bit later
+        store.lock("lock:" + key, 1.0)
+        threading.Timer(0.1, store.cache_set, (key, "1.5")).start()
+        assert get_score(store, "79175002040", "a@b") == 1.5
+        assert slow_calc == []
+
+    def test_releases_the_lock(self, slow_calc, monkeypatch):
+        monkeypatch.setattr(scoring, "SCORE_LOCK_TTL", 1.0)
+        store = LockingStore()
+        assert get_score(store, "79175002040", "a@b") == 3.0
+        assert store.locks == {}
+        assert len(slow_calc) == 1
+
+
+
+class TTLStore(LockingStore):
+    def __init__(self, ttl):
+        LockingStore.__init__(self)
+        self.ttl = ttl
+        self.durations = []
+
+    def cache_get_with_ttl(self, key):
+        value = self.data.get(key)
+        return value, self.ttl if value is not None else None
+
+    def cache_set(self, key, val, duration=60*60):
+        LockingStore.cache_set(self, key, val, duration)
+        self.durations.append(duration)
+
+    def cache_get_many(self, keys):
+        return [self.data.get(key) for key in keys]
+
+    def cache_get_many_with_ttl(self, keys):
+        return [self.cache_get_with_ttl(key) for key in keys]
+
+    def cache_set_many(self, mapping, duration=60*60):
+        for key, val in mapping.items():
+            self.cache_set(key, val, duration)
+
+
+class TestScoreRefresh:
+
+    def wait_for_refreshes(self):
+        deadline = time.time() + 5
+        while scoring._refreshing and time.time() < deadline:
+            time.sleep(0.01)
+
+    @pytest.fixture
+    def stale(self, monkeypatch):
+        monkeypatch.setattr(scoring, "SCORE_STALE_TTL", 60)
+
+    def test_stale_score_is_served_and_refreshed(self, stale):
+        store = TTLStore(ttl=30)
+        key = scoring.get_score_key()
+        store.data[key] = "1.5"
+        assert get_score(store, "79175002040", "a@b") == 1.5
+        self.wait_for_refreshes()
+        assert store.data[key] == 3.0
+        assert store.durations == [scoring.SCORE_TTL + 60]
+
+    def test_fresh_score_is_not_refreshed(self, stale):
+        store = TTLStore(ttl=90)
+        store.data[scoring.get_score_key()] = "1.5"
+        assert get_score(store, "79175002040", "a@b") == 1.5
+        self.wait_for_refreshes()
+        assert store.writes == []
+
+    def test_miss_is_computed_for_the_longer_lifetime(self, stale):
+        store = TTLStore(ttl=None)
+        assert get_score(store, "79175002040", "a@b") == 3.0
+        assert store.durations == [scoring.SCORE_TTL + 60]
+
+    @pytest.mark.parametrize("beta, refreshed", [(0, False), (1e9, True)])
+    def test_xfetch_refreshes_early(self, monkeypatch, beta, refreshed):
+        monkeypatch.setattr(scoring, "SCORE_XFETCH_BETA", beta)
+        store = TTLStore(ttl=10)
+        key = scoring.get_score_key()
+        store.data[key] = "1.5"
+        assert get_score(store, "79175002040", "a@b") == 1.5
+        self.wait_for_refreshes()
+        assert (store.data[key] == 3.0) is refreshed
+
+    def test_batch_refreshes_stale_scores_together(self, stale):
+        store = TTLStore(ttl=30)
+        items = [{"phone": "79175002040", "email": "a@b"}, {"phone": "79175002040", "email": "", "first_name": "a",
+                                                            "last_name": "b"}]
+        keys = [scoring.get_score_key(item.get("first_name"), item.get("last_name")) for item in items]
+        for key in keys:
+            store.data[key] = "1.5"
+        assert scoring.get_scores_many(store, items, keys) == [1.5, 1.5]
+        self.wait_for_refreshes()
+        assert [store.data[key] for key in keys] == [3.0, 2.0]
+        assert store.durations == [scoring.SCORE_TTL + 60] * 2
+        assert scoring._refresh_threads == 0
+
+    @pytest.mark.parametrize("beta, refreshed", [(0, False), (1e9, True)])
+    def test_batch_xfetch_refreshes_early(self, monkeypatch, beta, refreshed):
+        monkeypatch.setattr(scoring, "SCORE_XFETCH_BETA", beta)
+        store = TTLStore(ttl=10)
+        items = [{"phone": "79175002040", "email": "a@b"}]
+        key = scoring.get_score_key()
+        store.data[key] = "1.5"
+        assert scoring.get_scores_many(store, items, [key]) == [1.5]
+        self.wait_for_refreshes()
+        assert (store.data[key] == 3.0) is refreshed
+
+
+
+class TestScoreKeys:
+
+    def test_legacy_key_is_unchanged(self):
+        birthday = datetime.datetime(1990, 1, 1)
+        assert scoring.get_score_key("a", "b", birthday) == "uid:" + hashlib.md5("ab19900101").hexdigest()
+        assert scoring.get_score_key() == "uid:" + hashlib.md5("").hexdigest()
+
+    def test_unicode_names(self):
+        assert scoring.get_score_key(u"Стас", u"b") == "uid:" + hashlib.md5(u"Стасb".encode("utf-8")).hexdigest()
+
+    def test_request_derives_its_key_once(self, monkeypatch):
+        request = OnlineScoreRequest({"first_name": "a", "last_name": "b", "birthday": "01.01.1990", "gender": 1})
+        assert request.score_key == scoring.get_score_key("a", "b", datetime.datetime(1990, 1, 1))
+        monkeypatch.setattr(api, "get_score_key", None)
+        assert request.score_key.startswith("uid:")
+
+
+
+@pytest.fixture(params=["memory", "mmap"])
+def local_store(request, tmpdir):
+    if request.param == "memory":
+        yield MemoryStore(max_entries=100)
+    else:
+        store = MmapStore(str(tmpdir.join("store.mmap")), slots=64, slot_size=128)
+        yield store
+        store.close()
+
+
+class TestLocalStores:
+
+    def test_values_come_back_as_redis_returns_them(self, local_store):
+        local_store.cache_set("uid:1", 3.5)
+        local_store.cache_set("uid:2", 0)
+        local_store.set("i:1", u'["кино"]')
+        assert local_store.cache_get_many(["uid:1", "uid:2", "uid:3"]) == ["3.5", "0", None]
+        assert local_store.get_many(["i:1"]) == [u'["кино"]'.encode("utf-8")]
+        with pytest.raises(TypeError):
+            local_store.cache_set("uid:4", {"a": 1})
+
+    def test_ttl(self, local_store):
+        local_store.cache_set("uid:1", "1", 60)
+        local_store.set("i:1", "[]")
+        value, ttl = local_store.cache_get_with_ttl("uid:1")
+        assert value == "1" and 59 < ttl <= 60
+        assert local_store.cache_get_with_ttl("i:1") == ("[]", None)
+        assert local_store.cache_get_with_ttl("uid:2") == (None, None)
+        local_store.cache_set("uid:3", "1", 0.05)
+        time.sleep(0.1)
+        assert local_store.cache_get("uid:3") is None
+
+    def test_set_many_and_delete(self, local_store):
+        local_store.cache_set_many({"uid:1": 1.5, "uid:2": 3.0})
+        local_store.delete("uid:1")
+        assert local_store.cache_get_many(["uid:1", "uid:2"]) == [None, "3.0"]
+
+    def test_lock(self, local_store):
+        token = local_store.lock("lock:1", 1)
+        assert token is not None
+        assert local_store.lock("lock:1", 1) is None
+        local_store.unlock("lock:1", "someone else")
+        assert local_store.lock("lock:1", 1) is None
+        local_store.unlock("lock:1", token)
+        assert local_store.lock("lock:1", 0.05) is not None
+        time.sleep(0.1)
+        assert local_store.lock("lock:1", 1) is not None
+
+    def test_cache_writes_do_not_evict_values(self, local_store):
+        local_store.set("i:1", '["cars"]')
+        for i in range(200):
+            local_store.cache_set("uid:%s" % i, 1.5)
+        assert get_interests_many(local_store, [1]) == [["cars"]]
+        local_store.cache_set("i:1", '["pets"]')
+        assert local_store.get("i:1") == '["pets"]'
+
+    def test_scores_and_interests(self, local_store):
+        local_store.set("i:1", '["cars"]')
+        assert get_interests_many(local_store, [1, 2]) == [["cars"], []]
+        assert get_score(local_store, "79175002040", "a@b") == 3.0
+        assert local_store.cache_get(scoring.get_score_key()) == "3.0"
+
+    def test_scan_lists_live_keys(self, local_store, tmpdir):
+        local_store.set("i:1", '["cars"]')
+        local_store.set("i:2", '["pets"]')
+        local_store.set("i:3", '["tv"]')
+        local_store.delete("i:3")
+        local_store.cache_set("i:4", '["books"]', 0.05)
+        local_store.cache_set("uid:1", 1.5)
+        time.sleep(0.1)
+        assert sorted(local_store.scan("i:*")) == ["i:1", "i:2"]
+        path = str(tmpdir.join("interests.snapshot"))
+        assert snapshot.write_snapshot(path, snapshot.read_interests(local_store)) == 2
+
+
+class TestMmapStore:
+
+    def test_shared_between_mappings(self, tmpdir):
+        path = str(tmpdir.join("store.mmap"))
+        writer = MmapStore(path, slots=64, slot_size=128)
+        writer.cache_set("uid:1", 1.5)
+        # the layout comes from the file, not from the arguments
+        reader = MmapStore(path, slots=8, slot_size=64)
+        assert (reader.slots, reader.slot_size) == (64, 128)
+        assert reader.cache_get("uid:1") == "1.5"
+        reader.delete("uid:1")
+        assert writer.cache_get("uid:1") is None
+
+    def test_bounded_by_slots(self, tmpdir):
+        store = MmapStore(str(tmpdir.join("store.mmap")), slots=4, slot_size=64)
+        for i in range(20):
+            store.cache_set("uid:%s" % i, i, 60 + i)
+        assert store.cache_get("uid:19") == "19"
+        assert sum(value is not None for value in store.cache_get_many(["uid:%s" % i for i in range(20)])) == 4
+
+    def test_values_are_not_evicted(self, tmpdir):
+        store = MmapStore(str(tmpdir.join("store.mmap")), slots=4, slot_size=64)
+        for i in range(4):
+            store.set("i:%s" % i, "[]")
+        store.cache_set("uid:1", 1.5)
+        assert store.cache_get("uid:1") is None
+        with pytest.raises(ValueError):
+            store.set("i:4", "[]")
+        assert store.get_many(["i:%s" % i for i in range(4)]) == ["[]"] * 4
+
+    def test_value_larger_than_a_slot(self, tmpdir):
+        store = MmapStore(str(tmpdir.join("store.mmap")), slots=4, slot_size=32)
+        with pytest.raises(ValueError):
+            store.cache_set("uid:1", "x" * 32)
+
+    def test_rejects_other_files(self, tmpdir):
+        path = tmpdir.join("other")
+        path.write("not a store file")
+        with pytest.raises(ValueError):
+            MmapStore(str(path))